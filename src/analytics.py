@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from csv_export import EXPORT_NAME, file_key, read_rows
+from session_archive import archive_path, read_archive
+from storage import load_json_file
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, 'data')
+# /export_csv が書き出し時の baseline を残している目録（session_api）
+CATALOG_NAME = 'catalog.json'
+
+# 結果の形が変わったら上げる（古いキャッシュを使わないように）
+RESULT_VERSION = 2
+# サンプル間の空白はこれ以上を「測れていない時間」として数えない（ms）
+MAX_GAP_MS = 5000
+# 書き出し時の baseline が無い端末は最初のこの時間の中央値を baseline にする（ms）
+BASELINE_WINDOW_MS = 60_000
+# baseline からこれだけ上がった区間を「ピーク」として数える（BPM）
+EXCURSION_BPM = 15
+
+
+# ----------------------------------------
+# 保管済みセッション（data/ の CSV）のオフライン分析
+#   python analytics.py [--workers 4] [--json]
+#   - CSV は初回に NumPy の列（.npy）へ変換してキャッシュし、以降は mmap で読む
+#     （隣に圧縮アーカイブ .hra があれば CSV を解析せずにそちらから列を作る）
+#   - セッションごとの分析はプロセスプールで並列に行い、最後に端末ごとにまとめる
+#   - セッションごとの結果もキャッシュするので、新しいファイルだけが分析される
+#   - baseline はセッションごと（書き出し時に目録へ残した値、無ければ最初の1分の中央値）
+#     watchN は夜ごとに別の人なので、今の baseline.json は使わない
+# ----------------------------------------
+def _file_key(path):
+    return file_key(os.stat(path))
+
+def _session_dir(path):
+    # キャッシュは CSV と同じフォルダの .analytics/<ファイル名>/ に置く
+    return os.path.join(os.path.dirname(path), ".analytics", os.path.basename(path))
+
+def _read_csv(path):
+    devices = []
+    index = {}
+    d_col, t_col, h_col = [], [], []
+    for device_id, ts, hb in read_rows(path):
+        if device_id not in index:
+            index[device_id] = len(devices)
+            devices.append(device_id)
+        d_col.append(index[device_id])
+        t_col.append(ts)
+        h_col.append(hb)
+    return (
+        devices,
+        np.array(d_col, dtype=np.int16),
+        np.array(t_col, dtype=np.int64),
+        np.array(h_col, dtype=np.float32)
+    )
+
+def _read_archive(path):
+    devices = []
+    d_col, t_col, h_col = [], [], []
+    for i, (device_id, columns) in enumerate(read_archive(path).items()):
+        devices.append(device_id)
+        t = np.frombuffer(columns.timestamps, dtype=np.int64)
+        d_col.append(np.full(len(t), i, dtype=np.int16))
+        t_col.append(t)
+        h_col.append(np.frombuffer(columns.heartbeats, dtype=np.float32))
+    if not devices:
+        return [], np.empty(0, np.int16), np.empty(0, np.int64), np.empty(0, np.float32)
+    return devices, np.concatenate(d_col), np.concatenate(t_col), np.concatenate(h_col)
+
+def _read_columns(path):
+    # アーカイブが CSV より後に作られていればそちらを使う
+    hra = archive_path(path)
+    if os.path.exists(hra) and os.stat(hra).st_mtime_ns >= os.stat(path).st_mtime_ns:
+        return _read_archive(hra)
+    return _read_csv(path)
+
+def load_session(path):
+    # 戻り値: {device_id: (timestamps, heartbeats)}（時刻順、キャッシュがあれば mmap）
+    directory = _session_dir(path)
+    meta_path = os.path.join(directory, "meta.json")
+    key = _file_key(path)
+
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("key") != key:
+            meta = None
+
+    if meta is None:
+        devices, d, t, h = _read_columns(path)
+        # 端末ごと・時刻順に並べ替えて、端末ごとの区切り位置を覚えておく
+        order = np.lexsort((t, d))
+        d, t, h = d[order], t[order], h[order]
+        bounds = np.searchsorted(d, np.arange(len(devices) + 1)).tolist()
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "t.npy"), t)
+        np.save(os.path.join(directory, "h.npy"), h)
+        meta = {"key": key, "devices": devices, "bounds": bounds}
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    t = np.load(os.path.join(directory, "t.npy"), mmap_mode="r")
+    h = np.load(os.path.join(directory, "h.npy"), mmap_mode="r")
+    bounds = meta["bounds"]
+    return {
+        device_id: (t[bounds[i]:bounds[i + 1]], h[bounds[i]:bounds[i + 1]])
+        for i, device_id in enumerate(meta["devices"])
+    }
+
+
+# ----------------------------------------
+# 1セッション分の分析（プロセスプールのワーカーで動く）
+# ----------------------------------------
+def analyze_device(t, h, baseline=None):
+    if len(t) == 0:
+        return None
+    if baseline is None:
+        # baseline が無ければ最初の1分の中央値
+        head = h[t < t[0] + BASELINE_WINDOW_MS]
+        baseline = float(np.median(head))
+
+    # 各サンプルはそこから次のサンプルまで続いたとみなす（長すぎる空白は数えない）
+    dt = np.minimum(np.diff(t), MAX_GAP_MS)
+    above = h[:-1] > baseline
+    excursion = h - baseline
+    peak = int(np.argmax(excursion))
+
+    # baseline + EXCURSION_BPM を超えた区間の数（立ち上がりの数）
+    high = (excursion > EXCURSION_BPM).astype(np.int8)
+    rises = int(np.count_nonzero(np.diff(high) == 1) + high[0])
+
+    return {
+        "samples": int(len(t)),
+        "start": int(t[0]),
+        "end": int(t[-1]),
+        "measured_ms": int(dt.sum()),
+        "baseline": round(baseline, 1),
+        "mean": round(float(h.mean()), 1),
+        "min": round(float(h.min()), 1),
+        "max": round(float(h.max()), 1),
+        "above_baseline_ms": int(dt[above].sum()),
+        "peak_excursion": round(float(excursion[peak]), 1),
+        "peak_at": int(t[peak]),
+        "excursions": rises
+    }
+
+def session_baselines(path):
+    # 書き出し時に目録（data/catalog.json）へ残した、そのセッションの baseline
+    # 目録は storage 経由で読む（HEART_DB ではファイルではなく DB の documents にある）
+    catalog = load_json_file(os.path.join(os.path.dirname(path), CATALOG_NAME))
+    entry = catalog.get(os.path.basename(path)) or {}
+    return entry.get("baselines") or {}
+
+def analyze_session(path, baselines):
+    # 戻り値: {"file", "key", "version", "baselines", "devices": {device_id: 分析結果}}
+    name = os.path.basename(path)
+    result = {
+        "file": name, "key": _file_key(path), "version": RESULT_VERSION,
+        "baselines": baselines, "devices": {}
+    }
+    for device_id, (t, h) in load_session(path).items():
+        stats = analyze_device(t, h, baselines.get(device_id))
+        if stats is not None:
+            stats["baseline_source"] = "export" if device_id in baselines else "first_minute"
+            result["devices"][device_id] = stats
+    with open(os.path.join(_session_dir(path), "result.json"), "w") as f:
+        json.dump(result, f)
+    return result
+
+def _cached_result(path, baselines):
+    # ファイルと baseline のどちらかが変わっていたら分析し直す
+    result_path = os.path.join(_session_dir(path), "result.json")
+    if not os.path.exists(result_path):
+        return None
+    with open(result_path) as f:
+        result = json.load(f)
+    if result.get("version") != RESULT_VERSION or result.get("key") != _file_key(path):
+        return None
+    if result.get("baselines") != baselines:
+        return None
+    return result
+
+
+# ----------------------------------------
+# 全セッションの分析と端末ごとのまとめ
+# ----------------------------------------
+def session_paths(data_dir=DATA_DIR):
+    names = sorted(n for n in os.listdir(data_dir) if EXPORT_NAME.match(n))
+    return [os.path.join(data_dir, n) for n in names]
+
+def analyze_all(paths, workers=None):
+    # 戻り値: (セッションごとの結果のリスト, 新しく分析した数)
+    results = {}
+    pending = []
+    for path in paths:
+        baselines = session_baselines(path)
+        cached = _cached_result(path, baselines)
+        if cached is not None:
+            results[path] = cached
+        else:
+            pending.append((path, baselines))
+
+    if pending:
+        # 1セッション1タスクでワーカーへ配る
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            done = pool.map(analyze_session, [p for p, _ in pending], [b for _, b in pending])
+            for (path, _), result in zip(pending, done):
+                results[path] = result
+
+    return [results[path] for path in paths], len(pending)
+
+def merge(results):
+    # 端末ごとに全セッションを合算
+    players = {}
+    for result in results:
+        for device_id, stats in result["devices"].items():
+            p = players.setdefault(device_id, {
+                "sessions": 0, "samples": 0, "measured_ms": 0, "above_baseline_ms": 0,
+                "excursions": 0, "peak_excursion": None, "peak_session": None, "_sum": 0.0
+            })
+            p["sessions"] += 1
+            p["samples"] += stats["samples"]
+            p["measured_ms"] += stats["measured_ms"]
+            p["above_baseline_ms"] += stats["above_baseline_ms"]
+            p["excursions"] += stats["excursions"]
+            p["_sum"] += stats["mean"] * stats["samples"]
+            if p["peak_excursion"] is None or stats["peak_excursion"] > p["peak_excursion"]:
+                p["peak_excursion"] = stats["peak_excursion"]
+                p["peak_session"] = result["file"]
+
+    for p in players.values():
+        total = p.pop("_sum")
+        p["mean"] = round(total / p["samples"], 1) if p["samples"] else None
+        p["above_baseline_ratio"] = (
+            round(p["above_baseline_ms"] / p["measured_ms"], 3) if p["measured_ms"] else None
+        )
+    return dict(sorted(players.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保管済みセッションの心拍分析")
+    parser.add_argument("--data", default=DATA_DIR, help="CSV のあるフォルダ")
+    parser.add_argument("--workers", type=int, default=None, help="ワーカープロセス数（既定は CPU 数）")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力")
+    args = parser.parse_args()
+
+    paths = session_paths(args.data)
+    results, analyzed = analyze_all(paths, workers=args.workers)
+    players = merge(results)
+
+    if args.json:
+        print(json.dumps({"sessions": results, "players": players}, ensure_ascii=False, indent=2))
+        return
+
+    print(f"[ANALYTICS] セッション {len(paths)} 件（新しく分析 {analyzed} 件、残りはキャッシュ）")
+    print(f"{'player':<10} {'sessions':>8} {'mean':>6} {'above%':>7} {'peak':>6} {'excursions':>10}  peak_session")
+    for device_id, p in players.items():
+        ratio = "-" if p["above_baseline_ratio"] is None else f"{p['above_baseline_ratio'] * 100:.1f}"
+        print(
+            f"{device_id:<10} {p['sessions']:>8} {p['mean']:>6} {ratio:>7} "
+            f"{p['peak_excursion']:>6} {p['excursions']:>10}  {p['peak_session']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+import threading
+from bisect import bisect_left, insort
+from collections import deque
+
+import heart_db
+from heart_store import store
+from samples import bpm_value
+
+# baseline を出す直近の幅（ms）
+WINDOW_MS = int(os.environ.get("HEART_BASELINE_WINDOW_MS", "10000"))
+# baseline として保存するのに必要な件数
+MIN_SAMPLES = 5
+# トリム平均で上下から外す割合
+TRIM_RATIO = 0.1
+
+
+# ----------------------------------------
+# 端末1台分の直近 WINDOW_MS の窓
+#   届いた順の deque と合計（平均用）、値の昇順リスト（中央値・トリム平均用）を一緒に更新する
+# ----------------------------------------
+class BaselineWindow:
+    def __init__(self):
+        self.samples = deque()
+        self.sorted = []
+        self.total = 0.0
+
+    def add(self, timestamp, bpm):
+        self.samples.append((timestamp, bpm))
+        insort(self.sorted, bpm)
+        self.total += bpm
+
+    def expire(self, from_ts):
+        while self.samples and self.samples[0][0] < from_ts:
+            _, bpm = self.samples.popleft()
+            del self.sorted[bisect_left(self.sorted, bpm)]
+            self.total -= bpm
+
+    def estimate(self):
+        n = len(self.sorted)
+        if n == 0:
+            return {"samples": 0, "mean": None, "median": None, "trimmed_mean": None}
+        mid = n // 2
+        median = self.sorted[mid] if n % 2 else (self.sorted[mid - 1] + self.sorted[mid]) / 2
+        # 10件前後の窓でも上下1件ずつは外れるように四捨五入
+        cut = min(int(n * TRIM_RATIO + 0.5), (n - 1) // 2)
+        trimmed = self.sorted[cut:n - cut]
+        return {
+            "samples": n,
+            "mean": round(self.total / n, 1),
+            "median": round(median, 1),
+            "trimmed_mean": round(sum(trimmed) / len(trimmed), 1)
+        }
+
+
+# ----------------------------------------
+# 端末ごとの直近 WINDOW_MS の推定値
+#   受信のたびに add() で積む（/calculate_baseline は待たずにこれを読む）
+#   baseline_mode では絞らない：端末ごとの取得が重なって片方が先に
+#   /stop_baseline しても、もう片方の窓は途切れない（DB モードと同じ直近分）
+#   DB モードは別プロセスが受信していることがあるので、読む時に DB の直近分から作り直す
+# ----------------------------------------
+class BaselineTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {}
+
+    def add(self, device_id, timestamp, heartbeat):
+        bpm = bpm_value(heartbeat)
+        if bpm is None:
+            return
+        bpm = float(bpm)
+        with self.lock:
+            window = self.windows.get(device_id)
+            if window is None:
+                window = self.windows[device_id] = BaselineWindow()
+            window.add(timestamp, bpm)
+            window.expire(timestamp - WINDOW_MS)
+
+    def clear(self):
+        with self.lock:
+            self.windows.clear()
+
+    def _from_store(self, from_ts):
+        windows = {}
+        for device_id, columns in store.window_all(from_ts).items():
+            window = windows[device_id] = BaselineWindow()
+            for ts, hb in columns:
+                bpm = bpm_value(hb)
+                if bpm is not None:
+                    window.add(ts, float(bpm))
+        return windows
+
+    def estimates(self, now_ms):
+        # {device_id: {"samples", "mean", "median", "trimmed_mean"}}（直近 WINDOW_MS 分）
+        from_ts = now_ms - WINDOW_MS
+        if heart_db.enabled:
+            return {d: w.estimate() for d, w in sorted(self._from_store(from_ts).items())}
+        with self.lock:
+            result = {}
+            for device_id, window in sorted(self.windows.items()):
+                window.expire(from_ts)
+                result[device_id] = window.estimate()
+            return result
+
+    def estimate(self, device_id, now_ms):
+        return self.estimates(now_ms).get(device_id) or BaselineWindow().estimate()
+
+
+tracker = BaselineTracker()
@@ -0,0 +1,139 @@
+import csv
+import gzip
+import io
+import os
+import re
+import threading
+import time
+import zlib
+
+from resampled_view import expand_holds
+
+
+# この行数ごとにまとめて送る・書く
+CHUNK_ROWS = 2000
+
+# 保存する CSV の名前 heart_rate_data_<時刻>.csv(.gz)（以前の出力は秒、今は ms）
+#   目録（session_api）・分析（analytics）もこれで data/ の CSV を見分ける
+EXPORT_NAME = re.compile(r"^heart_rate_data_(\d+)\.csv(\.gz)?$")
+
+# 最後に払い出したファイル名の時刻（同じ ms に2回出しても名前が重ならないように）
+_last_ms = 0
+_name_lock = threading.Lock()
+
+
+# ----------------------------------------
+# CSV 出力（1回の読み出しでダウンロードと data/ への保存を同時に行う）
+#   行は少しずつ作って送るので、セッションが長くても CSV 全体をメモリに持たない
+#   compress=True なら gzip（保存するファイルも .csv.gz）
+# ----------------------------------------
+def csv_chunks(session, from_ts=None, to_ts=None, sinks=()):
+    # session: heart_api.read_session() の戻り値（端末ごとに時刻順で少しずつ読める）
+    # sinks には書いた行を1行ずつ渡す（セッション目録の集計・圧縮アーカイブ用）
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['device_id', 'timestamp', 'heartbeat'])  # ヘッダー行
+    count = 0
+    for device_id in session.devices():
+        # 保持区間はここで1秒ごとの行に展開する
+        for timestamp, heartbeat in expand_holds(session.samples(device_id), session.holds(device_id)):
+            if from_ts is not None and timestamp < from_ts:
+                continue
+            if to_ts is not None and timestamp >= to_ts:
+                break
+            writer.writerow([device_id, timestamp, heartbeat])
+            for sink in sinks:
+                sink.add(device_id, timestamp, heartbeat)
+            count += 1
+            if count % CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    yield buffer.getvalue()
+
+def _encode(chunks, compress):
+    encoder = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        if encoder is not None:
+            data = encoder.compress(data)
+        if data:
+            yield data
+    if encoder is not None:
+        yield encoder.flush()
+
+def export_name(stamp, compress=False):
+    return f"heart_rate_data_{stamp}.csv" + (".gz" if compress else "")
+
+def export_path(directory, compress=False):
+    # data/heart_rate_data_<ms>.csv(.gz)（ダブルクリックで同じ秒に2回出しても別の名前）
+    global _last_ms
+    with _name_lock:
+        _last_ms = max(int(time.time() * 1000), _last_ms + 1)
+        ms = _last_ms
+    return os.path.join(directory, export_name(ms, compress))
+
+def file_key(st):
+    # 保存した CSV が変わったかどうかの判定用（os.stat の結果から）
+    return [st.st_size, st.st_mtime_ns]
+
+def read_rows(path):
+    # 保存した CSV（.gz も）を (device_id, timestamp, heartbeat) で1行ずつ読む
+    # ヘッダー行と読めない行は飛ばす
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as raw:
+        reader = csv.reader(io.TextIOWrapper(raw, encoding="utf-8", newline=""))
+        next(reader, None)  # ヘッダー行
+        for row in reader:
+            try:
+                yield row[0], int(row[1]), float(row[2])
+            except (IndexError, ValueError):
+                continue
+
+def _claim(path):
+    # path.part を O_EXCL で作る。別のプロセスが同じ名前を使っていたら ms を1つずつずらす
+    while True:
+        if not os.path.exists(path):
+            try:
+                fd = os.open(path + ".part", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                return path, os.fdopen(fd, "wb")
+            except FileExistsError:
+                pass
+        directory, name = os.path.split(path)
+        match = EXPORT_NAME.match(name)
+        if match is None:
+            raise FileExistsError(path)
+        path = os.path.join(directory, export_name(int(match.group(1)) + 1, bool(match.group(2))))
+
+def stream_export(session, path, compress=False, from_ts=None, to_ts=None, sinks=(), on_complete=None):
+    # 送る bytes を順に返しながら、同じ bytes を path に書く
+    # 書き終わるまでは .part のまま置いておき、最後に名前を変えて on_complete(path) を呼ぶ
+    # （path が使われていたら別の名前にずらすので、実際の名前は on_complete に渡す方）
+    path, f = _claim(path)
+    tmp = path + ".part"
+    encoded = _encode(csv_chunks(session, from_ts, to_ts, sinks), compress)
+    done = False
+    try:
+        try:
+            for data in encoded:
+                f.write(data)
+                yield data
+        except GeneratorExit:
+            # ダウンロードが途中で切れても保存用のコピーは最後まで書く
+            for data in encoded:
+                f.write(data)
+            done = True
+            raise
+        done = True
+    finally:
+        if done:
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+        if done:
+            os.replace(tmp, path)
+            print(f"[CSV保存] {path} に保存されました")
+            if on_complete is not None:
+                on_complete(path)
+        else:
+            os.remove(tmp)
@@ -0,0 +1,182 @@
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+import heart_db
+
+
+# 再接続時に Last-Event-ID から再送できるイベント数
+HISTORY_SIZE = 2000
+# DB モードで他のワーカーのイベントを取り込む間隔（秒）
+POLL_INTERVAL = 0.05
+# DB モードで古いイベントを消す間隔（秒）
+PRUNE_INTERVAL = 60
+
+
+# ----------------------------------------
+# プロセス内イベントバス（SSE 配信用）
+#   kind: "sample" / "backfill" / "turn" / "status" / "baselines" / "clients" / "control_mode" / "resync"
+# ----------------------------------------
+class EventBus:
+    def __init__(self, history_size=HISTORY_SIZE):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=history_size)
+        # 起動時刻(ms)から始めて、再起動しても id（= 状態のバージョン）が戻らないようにする
+        self._last_id = int(time.time() * 1000)
+        self._boot_id = self._last_id
+        # kind ごとの最後のイベント id（ETag などの内容バージョンに使う）
+        self._versions = {}
+
+    def publish(self, kind, data):
+        with self._cond:
+            self._last_id += 1
+            self._events.append((self._last_id, kind, data))
+            self._versions[kind] = self._last_id
+            self._cond.notify_all()
+            return self._last_id
+
+    @property
+    def last_id(self):
+        with self._cond:
+            return self._last_id
+
+    def version(self, *kinds):
+        # kinds を省略したら全体のバージョン
+        with self._cond:
+            if not kinds:
+                return self._last_id
+            # resync（リセット）はどの内容も変える
+            ids = [self._versions.get(k, self._boot_id) for k in kinds + ("resync",)]
+            return max(ids)
+
+    def _since(self, last_id):
+        # 戻り値: (イベント一覧, 取りこぼしがあったか)
+        if last_id == self._last_id:
+            return [], False
+        if last_id > self._last_id:
+            # 別プロセスの id など、知らない id
+            return list(self._events), True
+        first_id = self._events[0][0] if self._events else self._last_id + 1
+        if last_id < first_id - 1:
+            # 再送できる範囲より古い（サーバー再起動をまたいだ場合も含む）
+            return list(self._events), True
+        # id は連番なので末尾から必要な件数だけ取り出す
+        count = self._last_id - last_id
+        events = list(itertools.islice(reversed(self._events), count))
+        events.reverse()
+        return events, False
+
+    def since(self, last_id):
+        with self._cond:
+            return self._since(last_id)
+
+    def wait(self, last_id, timeout):
+        with self._cond:
+            if last_id == self._last_id:
+                self._cond.wait(timeout)
+            return self._since(last_id)
+
+
+# ----------------------------------------
+# DB 版イベントバス（HEART_DB 有効時）
+#   publish は events テーブルへ書くだけ。id は DB の連番なので全ワーカーで共通
+#   各ワーカーは新しい行を取り込んで自分の履歴・バージョンに反映する
+#   （/stream はどのワーカーにつながっても同じ Last-Event-ID で続きを受け取れる）
+# ----------------------------------------
+class DbEventBus(EventBus):
+    def __init__(self, history_size=HISTORY_SIZE):
+        super().__init__(history_size)
+        with heart_db.transaction() as conn:
+            row = conn.execute("SELECT id FROM events WHERE kind = 'boot'").fetchone()
+            if row is None:
+                # 最初の1回だけ起動時刻(ms)の行を入れて、以降の id をそこから始める
+                conn.execute("INSERT INTO events (id, kind, data) VALUES (?, 'boot', '{}')", (self._boot_id,))
+            else:
+                self._boot_id = row[0]
+        self._last_id = self._boot_id
+        for kind, last in heart_db.connect().execute(
+            "SELECT kind, MAX(id) FROM events WHERE kind != 'boot' GROUP BY kind"
+        ):
+            self._versions[kind] = last
+        rows = heart_db.connect().execute(
+            "SELECT id, kind, data FROM events WHERE kind != 'boot' ORDER BY id DESC LIMIT ?",
+            (history_size,)
+        ).fetchall()
+        self._ingest(reversed(rows))
+
+    def _ingest(self, rows):
+        # ロックを持った状態で呼ぶ
+        for event_id, kind, data in rows:
+            self._events.append((event_id, kind, json.loads(data)))
+            self._versions[kind] = event_id
+            self._last_id = event_id
+
+    def _poll(self):
+        # 書き込み途中（自分のトランザクション内）の行はまだ取り込まない
+        if heart_db.in_transaction():
+            return
+        with self._cond:
+            rows = heart_db.connect().execute(
+                "SELECT id, kind, data FROM events WHERE id > ? ORDER BY id", (self._last_id,)
+            ).fetchall()
+            if rows:
+                self._ingest(rows)
+                self._cond.notify_all()
+
+    def publish(self, kind, data):
+        with heart_db.transaction() as conn:
+            event_id = conn.execute(
+                "INSERT INTO events (kind, data) VALUES (?, ?)",
+                (kind, json.dumps(data, ensure_ascii=False))
+            ).lastrowid
+        self._poll()
+        return event_id
+
+    @property
+    def last_id(self):
+        self._poll()
+        return super().last_id
+
+    def version(self, *kinds):
+        self._poll()
+        return super().version(*kinds)
+
+    def since(self, last_id):
+        self._poll()
+        return super().since(last_id)
+
+    def poll_thread(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                self._poll()
+            except Exception as e:
+                print("[DB ERROR] イベントの取り込み失敗:", e)
+
+    def prune_thread(self):
+        # 再送できる件数より古いイベントを消す（boot 行は残す）
+        while True:
+            time.sleep(PRUNE_INTERVAL)
+            try:
+                with heart_db.transaction() as conn:
+                    conn.execute(
+                        "DELETE FROM events WHERE kind != 'boot' AND id <= "
+                        "(SELECT MAX(id) FROM events) - ?", (self._events.maxlen,)
+                    )
+            except Exception as e:
+                print("[DB ERROR] イベントの掃除失敗:", e)
+
+    def start(self):
+        threading.Thread(target=self.poll_thread, daemon=True).start()
+        heart_db.run_as_leader(
+            lambda: threading.Thread(target=self.prune_thread, daemon=True).start()
+        )
+
+
+if heart_db.enabled:
+    bus = DbEventBus()
+    bus.start()
+else:
+    bus = EventBus()
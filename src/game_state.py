@@ -0,0 +1,204 @@
+import atexit
+import os
+import threading
+
+import heart_db
+from contextlib import nullcontext
+from event_bus import bus
+from storage import load_json_file, save_json_file
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+GAME_FILE = os.path.join(BASE_DIR, "game_status.json")
+TURN_FILE = os.path.join(BASE_DIR, "turn.json")
+CONTROL_FILE = os.path.join(BASE_DIR, "control_mode.json")
+
+DEFAULT_MODE = "self_fast"
+
+STATUS_FIELDS = ("running", "game_over", "baseline_mode")
+
+# フィールド → グループ（書き出すファイルと通知するイベントの単位）
+FIELD_GROUPS = {
+    "running": "status",
+    "game_over": "status",
+    "baseline_mode": "status",
+    "current_turn": "turn",
+    "mode": "control_mode"
+}
+GROUP_FILES = {
+    "status": GAME_FILE,
+    "turn": TURN_FILE,
+    "control_mode": CONTROL_FILE
+}
+
+
+def _read(path):
+    # 壊れたファイルなら初期値で起動する
+    try:
+        return load_json_file(path)
+    except (OSError, ValueError):
+        return {}
+
+
+# ----------------------------------------
+# ゲーム状態（running / game_over / baseline_mode / ターン / 制御モード）
+#   サーバー内ではこれが正。ファイルへは writer スレッドが後から書き出す
+#   状態は丸ごと差し替えるだけなので、読む側はロック不要で食い違わない
+#   HEART_DB（複数ワーカー）では DB が正。他のワーカーの更新は data_version で検知して読み直す
+# ----------------------------------------
+class GameState:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dirty = set()
+        self._wake = threading.Event()
+        # DB 時：data_version は接続（= スレッド）ごとの値なので、読み込んだ状態もスレッドごとに持つ
+        self._seen = threading.local()
+        self._state = self._load()
+
+    def _load(self):
+        status = _read(GAME_FILE)
+        state = {field: bool(status.get(field, False)) for field in STATUS_FIELDS}
+        state["current_turn"] = _read(TURN_FILE).get("current_turn")
+        state["mode"] = _read(CONTROL_FILE).get("mode", DEFAULT_MODE)
+        return state
+
+    def _current(self):
+        if not heart_db.enabled:
+            return self._state
+        version = heart_db.data_version()
+        if getattr(self._seen, "version", None) != version:
+            self._seen.version = version
+            self._seen.state = self._load()
+        return self._seen.state
+
+    # -------- 読み出し（ロックなし） --------
+    def snapshot(self):
+        return dict(self._current())
+
+    def status(self):
+        state = self._current()
+        return {field: state[field] for field in STATUS_FIELDS}
+
+    @property
+    def running(self):
+        return self._current()["running"]
+
+    @property
+    def game_over(self):
+        return self._current()["game_over"]
+
+    @property
+    def baseline_mode(self):
+        return self._current()["baseline_mode"]
+
+    @property
+    def fill_active(self):
+        # ゲーム中 or baseline取得中（心拍の空白を保持区間として残す）
+        state = self._current()
+        return state["running"] or state["baseline_mode"]
+
+    @property
+    def current_turn(self):
+        return self._current()["current_turn"]
+
+    @property
+    def mode(self):
+        return self._current()["mode"]
+
+    # -------- 更新 --------
+    def _payload(self, group, state):
+        if group == "status":
+            return {field: state[field] for field in STATUS_FIELDS}
+        if group == "turn":
+            return {"current_turn": state["current_turn"]}
+        return {"mode": state["mode"]}
+
+    def _shared_lock(self):
+        # DB 時はワーカー間でも更新を排他にする
+        return heart_db.process_lock("game_state") if heart_db.enabled else nullcontext()
+
+    def _base(self):
+        # ロックを持った状態で呼ぶ。DB 時は他のワーカーの更新を取り込んでから変更する
+        return self._load() if heart_db.enabled else self._state
+
+    def _commit(self, new_state, old_state, force=False):
+        # ロックを持った状態で呼ぶ
+        groups = {
+            FIELD_GROUPS[field]
+            for field in FIELD_GROUPS
+            if force or new_state[field] != old_state[field]
+        }
+        self._state = new_state
+        if heart_db.enabled:
+            # 自分の書き込みでは自分の接続の data_version は変わらないので直接入れる
+            self._seen.version = heart_db.data_version()
+            self._seen.state = new_state
+        # DB 時は状態とイベントを1つのトランザクションで書く（他のワーカーに途中が見えない）
+        with heart_db.transaction() if heart_db.enabled else nullcontext():
+            for group in sorted(groups):
+                if heart_db.enabled:
+                    # 他のワーカーがすぐ読めるよう同期で書く（WAL なので SD カードは待たない）
+                    save_json_file(GROUP_FILES[group], self._payload(group, new_state))
+                else:
+                    self._dirty.add(group)
+                # 状態の変更順とイベントの順番をそろえるためロック内で通知
+                bus.publish(group, self._payload(group, new_state))
+        if self._dirty:
+            self._wake.set()
+        return dict(new_state)
+
+    def update(self, **fields):
+        unknown = set(fields) - set(FIELD_GROUPS)
+        if unknown:
+            raise KeyError(", ".join(sorted(unknown)))
+        with self._lock, self._shared_lock():
+            base = self._base()
+            return self._commit(dict(base, **fields), base)
+
+    def advance_turn(self, ids):
+        # ids の中で次の人へ進める（読んでから書くまでを1回のロックで）
+        # 戻り値: (前のターン, 次のターン)
+        with self._lock, self._shared_lock():
+            base = self._base()
+            current = base["current_turn"]
+            if current in ids:
+                next_id = ids[(ids.index(current) + 1) % len(ids)]
+            else:
+                next_id = ids[0]
+            self._commit(dict(base, current_turn=next_id), base)
+        return current, next_id
+
+    def reset(self):
+        with self._lock, self._shared_lock():
+            base = self._base()
+            state = {field: False for field in STATUS_FIELDS}
+            state["current_turn"] = None
+            state["mode"] = DEFAULT_MODE
+            # リセット時はファイルも必ず書き直す
+            return self._commit(state, base, force=True)
+
+    # -------- ファイルへの書き出し --------
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                state = self._state
+            for group in sorted(dirty):
+                try:
+                    save_json_file(GROUP_FILES[group], self._payload(group, state))
+                except OSError as e:
+                    print(f"[STATE ERROR] {GROUP_FILES[group]} の書き込み失敗:", e)
+                    with self._lock:
+                        self._dirty.add(group)
+
+    def writer_thread(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self.flush()
+
+
+game_state = GameState()
+
+threading.Thread(target=game_state.writer_thread, daemon=True).start()
+atexit.register(game_state.flush)
@@ -0,0 +1,111 @@
+import atexit
+import os
+import threading
+import time
+from collections import deque
+
+
+# まとめて書き出す間隔（ms）。クラッシュ時に失うのは最大でこの時間分
+COMMIT_INTERVAL_MS = int(os.environ.get("HEART_COMMIT_INTERVAL_MS", "1000"))
+# この件数たまったら間隔を待たずに書き出す
+COMMIT_MAX_RECORDS = int(os.environ.get("HEART_COMMIT_MAX_RECORDS", "512"))
+
+
+# ----------------------------------------
+# グループコミット用の書き込みスレッド
+#   submit() はキューに積むだけで返る（SDカードを待たない）
+#   最初の1件から interval_ms 経つか max_records 件たまったら
+#   まとめて1回の追記 + fsync で書き出す
+# ----------------------------------------
+class GroupCommitWriter:
+    def __init__(self, log, interval_ms=COMMIT_INTERVAL_MS, max_records=COMMIT_MAX_RECORDS, on_commit=None):
+        self.log = log
+        self.interval = interval_ms / 1000
+        self.max_records = max_records
+        self.on_commit = on_commit
+        self._queue = deque()
+        self._cond = threading.Condition()
+        # 最初の未書き出しレコードが積まれた時刻
+        self._first_at = None
+        # 書き出しとリセットを排他にするロック
+        self.commit_lock = threading.Lock()
+        self.commits = 0
+        self.records = 0
+
+    @property
+    def durability_window_ms(self):
+        return int(self.interval * 1000)
+
+    def submit(self, records):
+        with self._cond:
+            was_empty = not self._queue
+            if was_empty:
+                self._first_at = time.monotonic()
+            self._queue.extend(records)
+            # 空だったら締め切りを、件数が上限に達したら即書き出しを知らせる
+            if was_empty or len(self._queue) >= self.max_records:
+                self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            batch = list(self._queue)
+            self._queue.clear()
+            self._first_at = None
+        return batch
+
+    def flush(self):
+        # 今たまっている分をすぐに書き出す（CSV出力の前など）
+        with self.commit_lock:
+            batch = self._take()
+            if not batch:
+                return 0
+            try:
+                self.log.append_many(batch)
+            except Exception:
+                # 書けなかった分はキューの先頭に戻して次回に回す
+                with self._cond:
+                    self._queue.extendleft(reversed(batch))
+                    self._first_at = time.monotonic()
+                raise
+            self.commits += 1
+            self.records += len(batch)
+        if self.on_commit:
+            self.on_commit()
+        return len(batch)
+
+    def discard(self):
+        # リセット時：未書き出し分を捨てる（呼び出し側で commit_lock を持つこと）
+        self._take()
+
+    def run(self):
+        while True:
+            with self._cond:
+                # 締め切りまで、または件数がたまるまで待つ
+                # （待っている間に flush / discard で空になることもある）
+                while True:
+                    if not self._queue:
+                        self._cond.wait()
+                        continue
+                    if len(self._queue) >= self.max_records:
+                        break
+                    remaining = self._first_at + self.interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            try:
+                self.flush()
+            except Exception as e:
+                print("[ERROR] 心拍データの書き出し失敗:", e)
+                time.sleep(self.interval)
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print("[ERROR] 終了時の心拍データの書き出し失敗:", e)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        # 通常の終了（Ctrl-C など）では残りを書き出す。失うのはクラッシュ時だけ
+        atexit.register(self._flush_at_exit)
+        print(f"[LOG] グループコミット: {self.durability_window_ms}ms ごと / {self.max_records}件ごと")
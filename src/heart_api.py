@@ -1,51 +1,76 @@
 from flask import Blueprint, request, jsonify
-import json
 import os
 import threading
 import time
+from contextlib import nullcontext
 from datetime import datetime
 
+import heart_db
+from heart_store import store
+from game_state import game_state
+from event_bus import bus
+from baseline_stats import tracker as baseline_tracker
+from sample_log import sample_log, compact_thread
+from sqlite_store import prune_thread
+from group_commit import GroupCommitWriter
+from http_cache import conditional_json
+from storage import load_json_file, save_json_file
+from samples import parse_heartbeat
 
 heart_api = Blueprint('heart_api', __name__)
 reset_api = Blueprint('reset_api', __name__)
 
-file_lock = threading.Lock()
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_FILE = os.path.join(BASE_DIR, 'heart_rates.json')
 HISTORY_FILE = os.path.join(BASE_DIR, 'heart_history.json')
-TURN_FILE = os.path.join(BASE_DIR, 'turn.json')
-GAME_FILE = os.path.join(BASE_DIR, "game_status.json")
+# DB へサンプルログを取り込んだ記録（DB モードで1回だけ取り込む）
+IMPORT_FILE = os.path.join(BASE_DIR, 'sample_log_import.json')
+
+# /heart/batch の1リクエストあたりの上限件数
+MAX_BATCH = 600
+# 端末時刻がサーバーより先に進んでいてよい許容幅（ms）
+FUTURE_TOLERANCE_MS = 5000
 
-# デバイスごとの最新保存タイムスタンプを記録
-latest_timestamps = {}
-# 最後に保存した heartbeat（補完用）
-latest_heartbeats = {}
 
 def is_game_running():
-    status = load_json_file(GAME_FILE)
-    return status.get("running", False)  # ← ここは実際のキー名に合わせる
+    return game_state.running
 
 def is_collecting_baseline():
-    status = load_json_file(GAME_FILE)
-    return status.get("baseline_mode", False)
+    return game_state.baseline_mode
 
 
-file_lock = threading.Lock()
+def _write_scope():
+    # DB モードはストアへの書き込みと通知を1つのトランザクションにまとめる
+    return heart_db.transaction() if heart_db.enabled else nullcontext()
 
-def load_json_file(filename):
-    with file_lock:
-        if not os.path.exists(filename):
-            return {}
-        with open(filename) as f:
-            content = f.read().strip()
-            return json.loads(content) if content else {}
+def record_sample(device_id, timestamp, heartbeat, hold=False):
+    # ストアへ積んで、/stream の購読者へ通知（baseline の推定値の窓にも足す）
+    with _write_scope():
+        store.append(device_id, timestamp, heartbeat, hold=hold)
+        baseline_tracker.add(device_id, timestamp, heartbeat)
+        bus.publish("sample", {
+            "device_id": device_id,
+            "timestamp": timestamp,
+            "heartbeat": heartbeat
+        })
 
-def save_json_file(filename, data):
-    with file_lock:
-        with open(filename, 'w') as f:
-            json.dump(data, f)
-            f.flush()
-            os.fsync(f.fileno())
+def record_samples(device_id, samples, hold=False):
+    # まとめて1回でストアへ積み、新しく届いた分だけ通知
+    # それまでの最新より古い分は backfill として一番古い時刻だけ通知する
+    # （/get_heart_data?since= がその秒から返し直す。ダッシュボードの /stream は見ない）
+    with _write_scope():
+        fresh = store.extend(device_id, samples, hold=hold)
+        if len(fresh) < len(samples):
+            fresh_ts = {timestamp for timestamp, _ in fresh}
+            late = [timestamp for timestamp, _ in samples if timestamp not in fresh_ts]
+            bus.publish("backfill", {"device_id": device_id, "from": min(late)})
+        for timestamp, heartbeat in fresh:
+            baseline_tracker.add(device_id, timestamp, heartbeat)
+            bus.publish("sample", {
+                "device_id": device_id,
+                "timestamp": timestamp,
+                "heartbeat": heartbeat
+            })
 
 # ----------------------------------------
 # 🔴 POST /heart（通常保存）
@@ -53,43 +78,27 @@ def save_json_file(filename, data):
 @heart_api.route('/heart', methods=['POST'])
 def post_heart():
     try:
-        game = load_json_file(GAME_FILE)
+        # ゲーム中 or baseline取得中なら、前回からの空白を保持区間として記録
+        fill_active = game_state.fill_active
 
-        if not game.get("running", False) and not game.get("baseline_mode", False):
+        if not fill_active:
             print("[ALLOW] ゲーム停止中でもPOST許可")
 
         data = request.get_json(force=True)
         device_id = data.get('device_id')
-        heartbeat = data.get("data", {}).get("heartbeat")
+        heartbeat = parse_heartbeat(data.get("data", {}).get("heartbeat"))
 
+        # 数値にできない心拍はストアに触る前に弾く
         if not device_id or heartbeat is None:
             return jsonify({"status": "error", "message": "invalid data"}), 400
 
         timestamp = int(time.time() * 1000)
 
-        # 保存処理
-        data_file = load_json_file(DATA_FILE)
-        data_file.setdefault(device_id, []).append({
-            "timestamp": timestamp,
-            "heartbeat": heartbeat
-        })
-        save_json_file(DATA_FILE, data_file)
-
-        # ヒストリも保存
-        history = load_json_file(HISTORY_FILE)
-        history.setdefault(device_id, []).append({
-            "time": timestamp,
-            "bpm": heartbeat
-        })
-        history[device_id] = history[device_id][-30:]
-        save_json_file(HISTORY_FILE, history)
+        # 保存処理（メモリに積むだけ、ファイルへは書き込みスレッドがまとめて書き出す）
+        record_sample(device_id, timestamp, heartbeat, hold=fill_active)
 
         print(f"[{datetime.now()}] 🔴 保存: {device_id}, BPM={heartbeat}, timestamp={timestamp}")
 
-        # 補完用データ更新
-        latest_timestamps[device_id] = timestamp
-        latest_heartbeats[device_id] = heartbeat
-
         return jsonify({"status": "ok"})
 
     except Exception as e:
@@ -97,80 +106,156 @@ def post_heart():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # ----------------------------------------
-# 🟡 自動補完スレッド（1秒間POSTが来ない場合）
+# 📦 POST /heart/batch（端末でバッファした複数件をまとめて保存）
+#   {"device_id": "watch1", "sent_at": 端末時刻(ms, 任意),
+#    "samples": [{"timestamp": 端末時刻(ms), "heartbeat": 72}, ...]}
+#   sent_at があれば端末とサーバーの時計のずれを補正する
 # ----------------------------------------
-def auto_fill_thread():
-    while True:
-        time.sleep(1)
-        now = int(time.time() * 1000)
-
-        game = load_json_file(GAME_FILE)
-
-        running = game.get("running", False)
-        baseline = game.get("baseline_mode", False)
-
-        # ❗ゲーム中 or baseline取得中以外は補完しないだけ
-        if not running and not baseline:
-            continue
+@heart_api.route('/heart/batch', methods=['POST'])
+def post_heart_batch():
+    try:
+        data = request.get_json(force=True)
+        device_id = data.get('device_id')
+        items = data.get("samples")
 
-        for device_id, last_ts in latest_timestamps.items():
-            diff = now - last_ts
+        if not device_id or not isinstance(items, list):
+            return jsonify({"status": "error", "message": "invalid data"}), 400
+        if len(items) > MAX_BATCH:
+            return jsonify({"status": "error", "message": f"samples は{MAX_BATCH}件までです"}), 413
+
+        now_ms = int(time.time() * 1000)
+        sent_at = data.get("sent_at")
+        offset = now_ms - int(sent_at) if isinstance(sent_at, (int, float)) else 0
+
+        samples = []
+        rejected = 0
+        for item in items:
+            try:
+                timestamp = int(item["timestamp"]) + offset
+                heartbeat = parse_heartbeat(item["heartbeat"])
+            except (KeyError, TypeError, ValueError, OverflowError):
+                rejected += 1
+                continue
+            if heartbeat is None or timestamp > now_ms + FUTURE_TOLERANCE_MS:
+                rejected += 1
+                continue
+            samples.append((timestamp, heartbeat))
 
-            if diff >= 1000:
-                heartbeat = latest_heartbeats.get(device_id)
-                if heartbeat is None:
-                    continue
+        record_samples(device_id, samples, hold=game_state.fill_active)
 
-                fake_ts = now
+        print(f"[{datetime.now()}] 📦 まとめて保存: {device_id}, {len(samples)}件 (除外 {rejected}件, 時刻補正 {offset:+d}ms)")
 
-                data_file = load_json_file(DATA_FILE)
-                data_file.setdefault(device_id, []).append({
-                    "timestamp": fake_ts,
-                    "heartbeat": heartbeat
-                })
-                save_json_file(DATA_FILE, data_file)
+        return jsonify({"status": "ok", "accepted": len(samples), "rejected": rejected})
 
-                latest_timestamps[device_id] = fake_ts
+    except Exception as e:
+        print("POST /heart/batch error:", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-                print(f"[{datetime.now()}] 🟡 補完保存: {device_id}, BPM={heartbeat}")
-                
-# スレッド起動（アプリ起動時に1回だけ実行）
-threading.Thread(target=auto_fill_thread, daemon=True).start()
+# ----------------------------------------
+# 💾 永続化（リクエスト処理の外でまとめて書き出す）
+# ----------------------------------------
+def save_history():
+    history = {d: columns.history_records() for d, columns in store.history().items()}
+    save_json_file(HISTORY_FILE, history, indent=None)
+
+# ストアの変更はキュー経由でサンプルログへグループコミット
+#   間隔・件数は HEART_COMMIT_INTERVAL_MS / HEART_COMMIT_MAX_RECORDS で変更可
+writer = GroupCommitWriter(sample_log, on_commit=save_history)
+store.set_sink(writer.submit)
+
+def persist_pending():
+    # 未書き出し分をすぐにサンプルログへ反映（DB モードは書いた時点で反映済み）
+    if not heart_db.enabled:
+        writer.flush()
+
+def read_session(devices=None, from_ts=None, to_ts=None):
+    # CSV 出力用に、今回のセッションの読み出しを返す（端末・時間で絞り込み可）
+    # devices() の端末ごとに samples() / holds() を時刻順に少しずつ読む
+    if heart_db.enabled:
+        return store.session(devices, from_ts, to_ts)
+    persist_pending()
+    return sample_log.session(devices, from_ts, to_ts)
+
+def reset_heart_data():
+    # 書き出し中のデータで上書きされないよう commit_lock を取ってから消す
+    with writer.commit_lock, _write_scope():
+        store.clear(on_cleared=writer.discard)
+        sample_log.clear()
+        save_json_file(DATA_FILE, {})
+    baseline_tracker.clear()
+
+def migrate_legacy_data():
+    # 旧形式の heart_rates.json しかない場合はサンプルログへ取り込む
+    if not sample_log.is_empty():
+        return
+    legacy = load_json_file(DATA_FILE)
+    records = [
+        (device_id, r["timestamp"], r["heartbeat"])
+        for device_id, entries in legacy.items()
+        for r in entries
+    ]
+    if records:
+        sample_log.append_many(records)
+        print(f"[LOG] heart_rates.json から {len(records)} 件を取り込みました")
+
+def import_sample_log():
+    # DB モード: 最初に起動したワーカーだけがサンプルログを DB へ取り込む
+    # （BEGIN IMMEDIATE で他のワーカーの確認・取り込みと排他になる）
+    with heart_db.transaction():
+        if load_json_file(IMPORT_FILE):
+            return
+        migrate_legacy_data()
+        # 生データは全部（アーカイブ込み）、保持期間で消した分は集計だけ
+        records = list(sample_log.replay_all(holds=True))
+        store.load(records, sample_log.pruned_rollups())
+        save_json_file(IMPORT_FILE, {"records": len(records), "imported_at": int(time.time() * 1000)})
+        print(f"[DB] サンプルログから {len(records)} 件を取り込みました")
+
+if heart_db.enabled:
+    import_sample_log()
+    # 古いデータの削除は1ワーカーだけで行う
+    heart_db.run_as_leader(
+        lambda: threading.Thread(target=prune_thread, args=(store,), daemon=True).start()
+    )
+else:
+    # 起動時にサンプルログをリプレイしてストアを復元
+    migrate_legacy_data()
+    store.load(sample_log.replay(holds=True), sample_log.rollups())
+
+    # スレッド起動（アプリ起動時に1回だけ実行）
+    writer.start()
+    threading.Thread(target=compact_thread, args=(sample_log,), daemon=True).start()
 
 @heart_api.route('/heart', methods=['GET'])
 def get_latest_heart_rates():
     try:
-        heart_data = load_json_file(DATA_FILE) or {}
-        turn = load_json_file(TURN_FILE) or {}
-        current_turn = turn.get("current_turn")
+        return conditional_json(latest_for_turn, "sample", "turn")
 
-        print(f"[API] 現在のターン取得 -> {current_turn}")
+    except Exception as e:
+        print("[ERROR] GET /heart failed:", e)
+        return jsonify({"status": "error", "message": str(e)}), 500  # ✅ ここもreturn
 
-        result = {}
+def latest_all():
+    return {d: sample.as_dict() for d, sample in store.latest_all().items()}
 
-        for device_id, records in heart_data.items():
-            if not records:
-                continue
-            latest = records[-1]
+def latest_for_turn():
+    heart_data = store.latest_all()
+    current_turn = game_state.current_turn
 
-            # ターンが未設定なら全員返す / ターン中ならその人だけ返す
-            if current_turn is None or current_turn == device_id:
-                result[device_id] = latest
+    print(f"[API] 現在のターン取得 -> {current_turn}")
 
-        return jsonify(result)  # ✅ 絶対returnする
+    result = {}
+
+    for device_id, latest in heart_data.items():
+        # ターンが未設定なら全員返す / ターン中ならその人だけ返す
+        if current_turn is None or current_turn == device_id:
+            result[device_id] = latest.as_dict()
+
+    return result
 
-    except Exception as e:
-        print("[ERROR] GET /heart failed:", e)
-        return jsonify({"status": "error", "message": str(e)}), 500  # ✅ ここもreturn
-        
 @heart_api.route('/heart_all', methods=['GET'])
 def get_latest_heart_rates_all():
-    heart_data = load_json_file(DATA_FILE)
-    result = {}
-    for device_id, records in heart_data.items():
-        if records:
-            result[device_id] = records[-1]
-    return jsonify(result)
+    return conditional_json(latest_all, "sample")
 
     print(f"[API] 現在のターン取得 -> {current_turn}")
     # print(f"[API] heart_data -> {heart_data}")
@@ -189,10 +274,11 @@ def get_latest_heart_rates_all():
 @reset_api.route('/reset', methods=['POST'])
 def reset():
     # heart_rates.json を空にする
-    save_json_file(DATA_FILE, {})
+    reset_heart_data()
 
-    # turn.json もリセット（任意）
-    save_json_file(TURN_FILE, {"current_turn": None})
+    # ターンもリセット（任意）
+    game_state.update(current_turn=None)
+    bus.publish("resync", {})
 
     # assigned_ids.json もリセットするなら
     # save_json_file(ASSIGNED_IDS_FILE, {})
@@ -200,59 +286,17 @@ def reset():
     print("[RESET] heart_rates.json などを初期化しました")
     return jsonify({"status": "ok", "message": "全データをリセットしました"})
 
-def heartbeat_complement_worker():
-    while True:
-        time.sleep(1)  # 毎秒チェック
-        now = int(time.time() * 1000)
-        data_file = load_json_file(DATA_FILE)
-
-        for device_id, last_time in latest_timestamps.items():
-            if device_id not in data_file or not data_file[device_id]:
-                continue
-
-            last_entry = data_file[device_id][-1]
-            time_diff = now - last_entry["timestamp"]
-
-            # 1秒以上経過 & 最終記録から補完されていない（重複防止）
-            if time_diff >= 1000 and last_time == last_entry["timestamp"]:
-                new_timestamp = last_entry["timestamp"] + 1000
-                new_entry = {
-                    "timestamp": new_timestamp,
-                    "heartbeat": last_entry["heartbeat"]
-                }
-                data_file[device_id].append(new_entry)
-                save_json_file(DATA_FILE, data_file)
-
-                # historyにも追加
-                history = load_json_file(HISTORY_FILE)
-                if device_id not in history:
-                    history[device_id] = []
-                history[device_id].append({
-                    "time": new_timestamp,
-                    "bpm": last_entry["heartbeat"]
-                })
-                history[device_id] = history[device_id][-30:]
-                save_json_file(HISTORY_FILE, history)
-
-                # 表示
-                readable = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(new_timestamp / 1000))
-                print(f"[{readable}] 🟡 補完: device={device_id}, BPM={last_entry['heartbeat']}, timestamp={new_timestamp}")
-
 @heart_api.route('/get_baselines', methods=['GET'])
 def get_baselines():
-    baseline = load_json_file('baseline.json')
-    return jsonify(baseline)
+    return conditional_json(lambda: load_json_file('baseline.json'), "baselines")
 
 @heart_api.route('/start_baseline', methods=['POST'])
 def start_baseline():
-    status = load_json_file(GAME_FILE)
-    status["baseline_mode"] = True
-    save_json_file(GAME_FILE, status)
+    game_state.update(baseline_mode=True)
     return jsonify({"status": "ok"})
 
 @heart_api.route('/stop_baseline', methods=['POST'])
 def stop_baseline():
-    status = load_json_file(GAME_FILE)
-    status["baseline_mode"] = False
-    save_json_file(GAME_FILE, status)
+    game_state.update(baseline_mode=False)
+    store.close_holds(int(time.time() * 1000))
     return jsonify({"status": "ok"})
\ No newline at end of file
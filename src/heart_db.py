@@ -0,0 +1,181 @@
+import fcntl
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ----------------------------------------
+# SQLite（WAL）バックエンド
+#   HEART_DB=heart.db のように指定した時だけ有効（未指定なら従来どおりファイル保存）
+#   有効にすると心拍・端末割り当て・baseline・ゲーム状態・イベントを1つの DB で共有するので
+#   複数ワーカーの WSGI サーバーで動かせる:
+#     HEART_DB=heart.db gunicorn -w 4 -k gthread --threads 16 -b 0.0.0.0:8080 main:app
+#   （/stream は接続を持ち続けるのでスレッド付きワーカーにすること）
+# ----------------------------------------
+DB_PATH = os.environ.get("HEART_DB", "")
+if DB_PATH and not os.path.isabs(DB_PATH):
+    DB_PATH = os.path.join(BASE_DIR, DB_PATH)
+enabled = bool(DB_PATH)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    device_id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    heartbeat NUMERIC NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_device_ts ON samples (device_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS devices (
+    device_id TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS holds (
+    device_id TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    until INTEGER NOT NULL,
+    heartbeat NUMERIC NOT NULL
+);
+CREATE INDEX IF NOT EXISTS holds_device_start ON holds (device_id, start);
+
+CREATE TABLE IF NOT EXISTS rollups (
+    device_id TEXT NOT NULL,
+    bucket_ms INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    total NUMERIC NOT NULL,
+    low NUMERIC NOT NULL,
+    high NUMERIC NOT NULL,
+    PRIMARY KEY (device_id, bucket_ms, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS documents (
+    name TEXT PRIMARY KEY,
+    body TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+_local = threading.local()
+
+
+def connect():
+    # スレッドごとに1本の接続
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL なら NORMAL でもコミット順は保たれる（fsync はチェックポイント時だけ）
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _local.conn = conn
+        _local.depth = 0
+    return conn
+
+@contextmanager
+def transaction():
+    # 書き込みトランザクション（入れ子で呼んでも外側でまとめてコミット）
+    conn = connect()
+    if _local.depth == 0:
+        conn.execute("BEGIN IMMEDIATE")
+    _local.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        _local.depth -= 1
+        if _local.depth == 0:
+            conn.execute("ROLLBACK")
+        raise
+    _local.depth -= 1
+    if _local.depth == 0:
+        conn.execute("COMMIT")
+
+def in_transaction():
+    return getattr(_local, "depth", 0) > 0
+
+def data_version():
+    # 他の接続がコミットすると変わる値（変化の確認だけなら1回の PRAGMA で済む）
+    return connect().execute("PRAGMA data_version").fetchone()[0]
+
+
+# ----------------------------------------
+# プロセスをまたぐロック（flock）
+#   読んでから書くまでを複数ワーカーの間で排他にする
+# ----------------------------------------
+class ProcessLock:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._lock.acquire()
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            self._local.file = open(self.path, "a")
+            fcntl.flock(self._local.file, fcntl.LOCK_EX)
+        self._local.depth = depth + 1
+        return self
+
+    def __exit__(self, *exc):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            fcntl.flock(self._local.file, fcntl.LOCK_UN)
+            self._local.file.close()
+        self._lock.release()
+
+_process_locks = {}
+_process_locks_lock = threading.Lock()
+
+def process_lock(name):
+    path = f"{DB_PATH}.{os.path.basename(name)}.lock"
+    with _process_locks_lock:
+        lock = _process_locks.get(path)
+        if lock is None:
+            lock = _process_locks[path] = ProcessLock(path)
+        return lock
+
+
+# ----------------------------------------
+# 裏方のスレッド（UDP 受信・DB の掃除など）を動かすワーカーの選出
+#   リーダーのロックを取れた1プロセスだけが start() を実行する
+#   リーダーが落ちるとロックが外れ、待っていた別のワーカーが引き継ぐ
+# ----------------------------------------
+_leader_lock = threading.Lock()
+_leader_tasks = []
+_leader_file = None
+_is_leader = False
+
+def _elect():
+    global _leader_file, _is_leader
+    _leader_file = open(f"{DB_PATH}.leader", "a")
+    # ロックは開いたままにしてプロセスが終わるまで持ち続ける
+    fcntl.flock(_leader_file, fcntl.LOCK_EX)
+    print(f"[DB] pid={os.getpid()} が裏方のワーカーになりました")
+    with _leader_lock:
+        _is_leader = True
+        tasks = list(_leader_tasks)
+        _leader_tasks.clear()
+    for start in tasks:
+        start()
+
+def run_as_leader(start):
+    if not enabled:
+        # 単一プロセスなら自分がリーダー
+        start()
+        return
+    with _leader_lock:
+        if not _is_leader:
+            first = not _leader_tasks and _leader_file is None
+            _leader_tasks.append(start)
+            if first:
+                threading.Thread(target=_elect, daemon=True).start()
+            return
+    start()
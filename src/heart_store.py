@@ -0,0 +1,292 @@
+import threading
+from array import array
+
+import heart_db
+from resampled_view import ResampledSeries, TICK_MS
+from rollups import make_rings, RAW_RETENTION_MIN
+from samples import Sample, Columns, bpm_value
+from sqlite_store import SqliteHeartStore
+
+# デバイスごとのリングバッファ容量（1Hz で HEART_RAW_RETENTION_MIN 分、既定は約2時間）
+# それより古い分は rollups の集計（10秒 / 1分ごと）で読む
+RING_CAPACITY = RAW_RETENTION_MIN * 60
+# heart_history.json に残す件数
+HISTORY_LENGTH = 30
+
+
+# ----------------------------------------
+# デバイス1台分のリングバッファ
+#   timestamp は int64、heartbeat は float32 の array（1件12バイト）
+# ----------------------------------------
+class DeviceRing:
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = array('q', bytes(8 * capacity))
+        self.heartbeats = array('f', bytes(4 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def _index(self, n):
+        return (self.start + n) % self.capacity
+
+    def append(self, timestamp, heartbeat):
+        # 満杯で最古より古いサンプルは捨てる
+        if self.size == self.capacity and timestamp < self.timestamps[self.start]:
+            return
+        end = self._index(self.size)
+        self.timestamps[end] = timestamp
+        self.heartbeats[end] = heartbeat
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            # 満杯なら一番古いものを上書き
+            self.start = (self.start + 1) % self.capacity
+
+        # 時刻順を保つ（遅れて届いたサンプルだけ後ろから入れ替える）
+        n = self.size - 1
+        while n > 0:
+            cur, prev = self._index(n), self._index(n - 1)
+            if self.timestamps[prev] <= self.timestamps[cur]:
+                break
+            self.timestamps[prev], self.timestamps[cur] = self.timestamps[cur], self.timestamps[prev]
+            self.heartbeats[prev], self.heartbeats[cur] = self.heartbeats[cur], self.heartbeats[prev]
+            n -= 1
+
+    def bisect_left(self, timestamp):
+        # timestamp 以上になる最初の論理インデックス
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[self._index(mid)] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def latest(self):
+        if self.size == 0:
+            return None
+        i = self._index(self.size - 1)
+        return self.timestamps[i], self.heartbeats[i]
+
+    def columns(self, lo, hi):
+        # 論理インデックス [lo, hi) を array のまま切り出す（折り返しは2回のスライス）
+        if lo >= hi:
+            return Columns()
+        first, last = self._index(lo), self._index(hi - 1) + 1
+        if first < last:
+            return Columns(self.timestamps[first:last], self.heartbeats[first:last])
+        return Columns(
+            self.timestamps[first:] + self.timestamps[:last],
+            self.heartbeats[first:] + self.heartbeats[:last]
+        )
+
+    def slice(self, lo, hi):
+        return list(self.columns(lo, hi))
+
+    def tail(self, count):
+        return self.columns(self.size - min(count, self.size), self.size)
+
+    def range(self, from_ts, to_ts=None):
+        # [from_ts, to_ts) を O(log n + k) で取り出す
+        lo = self.bisect_left(from_ts)
+        hi = self.size if to_ts is None else self.bisect_left(to_ts)
+        return self.columns(lo, hi)
+
+
+# ----------------------------------------
+# プロセス共通の心拍ストア（POST /heart のホットストア）
+# ----------------------------------------
+class HeartStore:
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._rings = {}
+        # デバイスごとの 1Hz リサンプル済み系列（前方補完込み）
+        self._views = {}
+        # デバイスごとの集計（段ごとの RollupRing）
+        self._rollups = {}
+        # 保持区間を記録済みの時刻（同じ区間を二重に記録しない）
+        self._held_until = {}
+        # 書き出し先（GroupCommitWriter.submit など）。None なら書き出さない
+        self._sink = None
+
+    def _ring(self, device_id):
+        ring = self._rings.get(device_id)
+        if ring is None:
+            ring = self._rings[device_id] = DeviceRing(self.capacity)
+            self._views[device_id] = ResampledSeries(self.capacity)
+            self._rollups[device_id] = make_rings()
+        return ring
+
+    def _add(self, device_id, timestamp, heartbeat):
+        # 生サンプルと集計を同時に更新
+        self._ring(device_id).append(timestamp, heartbeat)
+        for rollup in self._rollups[device_id]:
+            rollup.add(timestamp, heartbeat)
+
+    def _rebuild_view(self, device_id, from_sec):
+        ring = self._rings[device_id]
+        view = self._views[device_id]
+        if ring.size == 0:
+            return
+        # from_sec の直前の1件から渡して保持値を引き継ぐ
+        lo = max(ring.bisect_left(from_sec * TICK_MS) - 1, 0)
+        to_sec = ring.latest()[0] // TICK_MS
+        if view.base_sec is not None:
+            to_sec = max(to_sec, view.end_sec)
+        view.rebuild(ring.slice(lo, ring.size), from_sec, to_sec)
+
+    def _mark_hold(self, device_id, until_ts):
+        # 直前の実測値から until_ts までを保持区間として記録（補完値そのものは作らない）
+        ring = self._rings.get(device_id)
+        if ring is None or ring.size == 0:
+            return
+        last_ts, last_hb = ring.latest()
+        start = max(last_ts, self._held_until.get(device_id, 0))
+        if until_ts - start > TICK_MS:
+            self._emit([(device_id, start, bpm_value(last_hb), until_ts)])
+            self._held_until[device_id] = until_ts
+
+    def append(self, device_id, timestamp, heartbeat, hold=False):
+        # hold=True（ゲーム中/ベースライン取得中）なら直前からの空白を保持区間として残す
+        with self._lock:
+            if hold:
+                self._mark_hold(device_id, timestamp)
+            ring = self._ring(device_id)
+            self._add(device_id, timestamp, heartbeat)
+            # 遅れて届いたサンプルはその秒から系列を作り直す
+            late = ring.latest()[0] != timestamp
+            if late or not self._views[device_id].add(timestamp, heartbeat):
+                self._rebuild_view(device_id, timestamp // TICK_MS)
+            self._emit([(device_id, timestamp, heartbeat)])
+
+    def extend(self, device_id, samples, hold=False):
+        # まとめて届いたサンプル（端末側でバッファしていた分など）を1回のロックで積む
+        # 戻り値: それまでの最新より新しかったサンプル（通知用）
+        samples = sorted(samples, key=lambda s: s[0])
+        if not samples:
+            return []
+        with self._lock:
+            ring = self._ring(device_id)
+            prev = ring.latest()
+            prev_ts = prev[0] if prev else None
+            for timestamp, heartbeat in samples:
+                if hold:
+                    self._mark_hold(device_id, timestamp)
+                self._add(device_id, timestamp, heartbeat)
+                self._emit([(device_id, timestamp, heartbeat)])
+            # 系列は一番古いサンプルの秒から1回だけ作り直す
+            self._rebuild_view(device_id, samples[0][0] // TICK_MS)
+        if prev_ts is None:
+            return samples
+        return [s for s in samples if s[0] > prev_ts]
+
+    def load(self, samples, rollups=None):
+        # 起動時にサンプルログのリプレイから復元（永続化キューには積まない）
+        # samples: [(device_id, timestamp, heartbeat), ...]（保持区間は until 付きの4要素）
+        # rollups: ログから削った古い分の集計 {device_id: {bucket_ms: [row, ...]}}
+        with self._lock:
+            self._rings.clear()
+            self._views.clear()
+            self._rollups.clear()
+            self._held_until.clear()
+            for device_id, tiers in (rollups or {}).items():
+                self._ring(device_id)
+                for rollup in self._rollups[device_id]:
+                    for row in tiers.get(rollup.bucket_ms, []):
+                        rollup.merge(*row)
+            for rec in samples:
+                if len(rec) > 3:
+                    held = self._held_until.get(rec[0], 0)
+                    self._held_until[rec[0]] = max(held, rec[3])
+                    continue
+                self._add(*rec)
+            # リサンプル系列はまとめて作り直す（長い区間は NumPy）
+            for device_id, ring in self._rings.items():
+                if ring.size:
+                    self._rebuild_view(device_id, ring.slice(0, 1)[0][0] // TICK_MS)
+
+    def close_holds(self, until_ts):
+        # ゲーム停止時などに、最後の実測値から until_ts までの保持区間を閉じる
+        with self._lock:
+            for device_id in self._rings:
+                self._mark_hold(device_id, until_ts)
+
+    def clear(self, on_cleared=None):
+        # on_cleared はロック内で呼ぶ（書き出しキューを同時に空にする時など）
+        with self._lock:
+            self._rings.clear()
+            self._views.clear()
+            self._rollups.clear()
+            self._held_until.clear()
+            if on_cleared:
+                on_cleared()
+
+    def set_sink(self, sink):
+        # 変更（サンプルと保持区間）を受け取る書き出し先を登録
+        self._sink = sink
+
+    def _emit(self, records):
+        # ロックを持った状態で呼ぶ（ログの順番をストアの更新順にそろえる）
+        if self._sink is not None:
+            self._sink(records)
+
+    def devices(self):
+        with self._lock:
+            return [d for d, ring in self._rings.items() if ring.size]
+
+    # ---- 読み出し（Sample / Columns で返す。dict にするのは API 側） ----
+    def latest(self, device_id):
+        with self._lock:
+            ring = self._rings.get(device_id)
+            item = ring.latest() if ring else None
+        if item is None:
+            return None
+        return Sample(*item)
+
+    def latest_all(self):
+        with self._lock:
+            items = {d: ring.latest() for d, ring in self._rings.items() if ring.size}
+        return {d: Sample(*item) for d, item in items.items()}
+
+    def window(self, device_id, from_ts, to_ts=None):
+        with self._lock:
+            ring = self._rings.get(device_id)
+            return ring.range(from_ts, to_ts) if ring else Columns()
+
+    def window_all(self, from_ts, to_ts=None):
+        with self._lock:
+            return {d: ring.range(from_ts, to_ts) for d, ring in self._rings.items()}
+
+    def resampled_all(self, from_ts, now_ms, fill=True):
+        # 1Hz 系列を現在時刻まで伸ばしてから切り出すだけ
+        # fill=False（ゲーム中でも baseline 取得中でもない）なら最後の実測値の秒までで止める
+        now_sec = now_ms // TICK_MS
+        from_sec = from_ts // TICK_MS
+        with self._lock:
+            items = {}
+            for device_id, view in self._views.items():
+                view.advance(now_sec)
+                to_sec = now_sec if fill or view.last_sec is None else min(now_sec, view.last_sec)
+                items[device_id] = view.slice(from_sec, to_sec)
+        return {d: columns for d, columns in items.items() if len(columns)}
+
+    def rollup_all(self, bucket_ms, from_ts, to_ts=None):
+        # 長い区間のグラフ用：集計の段から (バケット, 件数, 合計, 最小, 最大) を切り出す
+        with self._lock:
+            items = {}
+            for device_id, rollups in self._rollups.items():
+                for rollup in rollups:
+                    if rollup.bucket_ms == bucket_ms:
+                        items[device_id] = rollup.rows(from_ts, to_ts)
+        return {d: rows for d, rows in items.items() if rows}
+
+    def history(self):
+        # heart_history.json 用（デバイスごとの直近30件）
+        with self._lock:
+            return {d: ring.tail(HISTORY_LENGTH) for d, ring in self._rings.items()}
+
+
+# HEART_DB が有効なら全ワーカーで共有する SQLite 版
+store = SqliteHeartStore(HISTORY_LENGTH) if heart_db.enabled else HeartStore()
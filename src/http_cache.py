@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+
+from flask import request, Response
+
+from event_bus import bus
+from json_codec import dumps
+
+
+# 覚えておくレスポンスの数（エンドポイント + クエリごとに1つ）
+CACHE_ENTRIES = 256
+
+
+# ----------------------------------------
+# 作ったレスポンス本文のキャッシュ
+#   キー（エンドポイント + クエリ）ごとに最新のバージョンの本文を1つだけ持つ
+#   書き込みでバージョンが変われば自然に作り直しになる
+#   同じキーの同時リクエストは1つだけが作り、残りはそれを待って使う（single-flight）
+# ----------------------------------------
+class ResponseCache:
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._cond = threading.Condition()
+        self._entries = OrderedDict()
+        # 作っている最中のキー
+        self._building = set()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, version, render):
+        # render() は本文の bytes を返す関数
+        with self._cond:
+            waited = False
+            while True:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == version:
+                    self._entries.move_to_end(key)
+                    if waited:
+                        self.coalesced += 1
+                    else:
+                        self.hits += 1
+                    return entry[1]
+                if key not in self._building:
+                    self._building.add(key)
+                    self.misses += 1
+                    break
+                # 他のリクエストが作り終わるのを待つ（古いバージョンだったら自分で作る）
+                waited = True
+                self._cond.wait()
+
+        try:
+            body = render()
+        except BaseException:
+            with self._cond:
+                self._building.discard(key)
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            current = self._entries.get(key)
+            # 後から別のバージョンが入っていたら上書きしない（バージョンは増える一方）
+            if current is None or current[0] < version:
+                self._entries[key] = (version, body)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            self._building.discard(key)
+            self._cond.notify_all()
+        return body
+
+    def stats(self):
+        with self._cond:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced
+            }
+
+
+response_cache = ResponseCache()
+
+
+def cached_json(build, version):
+    # build() の結果を JSON にした本文を (パス + クエリ, version) でキャッシュして返す
+    # version は比較できる値（イベント id や (id, 秒) のタプル）
+    # 書き出しは json_codec（orjson があれば使う）
+    key = request.full_path
+    body = response_cache.get(key, version, lambda: dumps(build()))
+    return Response(body, mimetype="application/json")
+
+
+# ----------------------------------------
+# ETag / If-None-Match による条件付きレスポンス
+#   内容のバージョン（イベントバスの kind ごとの id）を ETag にして、
+#   変わっていなければ本文を作らずに 304 を返す
+#   本文を作る時も同じバージョンならキャッシュから返す
+# ----------------------------------------
+def conditional_json(build, *kinds, extra=None):
+    version = bus.version(*kinds)
+    tag = f"{'+'.join(kinds) or 'all'}-{version}"
+    if extra is not None:
+        tag += f"-{extra}"
+
+    if request.if_none_match.contains(tag):
+        response = Response(status=304)
+    else:
+        response = cached_json(build, (version, str(extra)))
+
+    response.set_etag(tag)
+    # キャッシュしてよいが、使う前に必ず問い合わせる
+    response.headers["Cache-Control"] = "no-cache"
+    return response
@@ -0,0 +1,181 @@
+from flask import Blueprint, jsonify
+import os
+import socket
+import struct
+import threading
+import time
+
+import heart_db
+from heart_api import record_sample, FUTURE_TOLERANCE_MS
+from game_state import game_state
+from samples import parse_heartbeat
+
+ingest_api = Blueprint('ingest_api', __name__)
+
+# HEART_UDP_PORT を指定した時だけ UDP の受信を有効にする（例: 9090）
+UDP_HOST = os.environ.get("HEART_UDP_HOST", "0.0.0.0")
+UDP_PORT = int(os.environ.get("HEART_UDP_PORT", "0") or 0)
+
+# ----------------------------------------
+# データグラムの形式（1件32バイト、ネットワークバイトオーダー）
+#   version(uint8) / device_id(15バイト, 余りは\0) / seq(uint32)
+#   / timestamp(int64, ms, 0ならサーバー時刻) / bpm(float32)
+#   1つのデータグラムに複数件を続けて入れてよい
+# ----------------------------------------
+RECORD = struct.Struct("!B15sIqf")
+VERSION = 1
+
+# 遅れて届いたパケットを受け付ける範囲（これより古い seq は端末の再起動とみなす）
+REORDER_WINDOW = 64
+WINDOW_MASK = (1 << REORDER_WINDOW) - 1
+SEQ_MOD = 1 << 32
+
+
+def pack_sample(device_id, seq, timestamp, bpm):
+    # 送信側（テストや中継用）
+    return RECORD.pack(VERSION, device_id.encode("ascii"), seq % SEQ_MOD, timestamp, bpm)
+
+
+# ----------------------------------------
+# seq による重複除去と欠損カウント（端末ごと）
+#   seq が戻っても端末時刻がそれまでの最新より新しければ再起動とみなす
+#   （64件送る前に再起動した端末の 0, 1, 2... を重複として捨てないため）
+# ----------------------------------------
+class SequenceTracker:
+    def __init__(self):
+        self.last_seq = None
+        # 直近 REORDER_WINDOW 件の受信済みビット（bit0 = last_seq）
+        self.seen = 0
+        # 受け付けた端末時刻の最新（ms、端末時刻が無ければ None のまま）
+        self.last_ts = None
+        self.received = 0
+        self.duplicates = 0
+        self.lost = 0
+        self.resets = 0
+
+    def _newer(self, timestamp):
+        return timestamp > 0 and self.last_ts is not None and timestamp > self.last_ts
+
+    def _take(self, seq, timestamp):
+        self.last_seq, self.seen = seq, 1
+        if timestamp > 0:
+            self.last_ts = max(self.last_ts or 0, timestamp)
+        self.received += 1
+        return True
+
+    def accept(self, seq, timestamp=0):
+        # 新しいサンプルなら True、重複なら False
+        # timestamp はデータグラムの端末時刻（ms、0 ならサーバー時刻で判定に使わない）
+        if self.last_seq is None:
+            return self._take(seq, timestamp)
+
+        ahead = (seq - self.last_seq) % SEQ_MOD
+        if 0 < ahead < SEQ_MOD // 2:
+            # 先に進んだ：飛ばした分は欠損として数える
+            self.lost += ahead - 1
+            self.seen = ((self.seen << ahead) | 1) & WINDOW_MASK
+            self.last_seq = seq
+            if timestamp > 0:
+                self.last_ts = max(self.last_ts or 0, timestamp)
+            self.received += 1
+            return True
+
+        behind = (SEQ_MOD - ahead) % SEQ_MOD
+        if behind >= REORDER_WINDOW or self._newer(timestamp):
+            # 大きく戻った、または戻ったのに時刻は新しい → 端末が再起動して seq が振り直された
+            self.resets += 1
+            return self._take(seq, timestamp)
+
+        bit = 1 << behind
+        if self.seen & bit:
+            self.duplicates += 1
+            return False
+        # 欠損扱いにしていたものが遅れて届いた
+        self.seen |= bit
+        self.lost = max(self.lost - 1, 0)
+        self.received += 1
+        return True
+
+    def stats(self):
+        return {
+            "last_seq": self.last_seq,
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "lost": self.lost,
+            "resets": self.resets
+        }
+
+
+trackers = {}
+trackers_lock = threading.Lock()
+counters = {"datagrams": 0, "malformed": 0}
+
+
+def handle_datagram(payload, now_ms=None):
+    if not payload or len(payload) % RECORD.size:
+        counters["malformed"] += 1
+        return 0
+
+    now_ms = now_ms or int(time.time() * 1000)
+    fill_active = game_state.fill_active
+
+    stored = 0
+    for version, raw_id, seq, timestamp, bpm in RECORD.iter_unpack(payload):
+        device_id = raw_id.rstrip(b"\0").decode("ascii", "replace")
+        heartbeat = parse_heartbeat(bpm)
+        if version != VERSION or not device_id or heartbeat is None:
+            counters["malformed"] += 1
+            continue
+
+        with trackers_lock:
+            tracker = trackers.setdefault(device_id, SequenceTracker())
+            fresh = tracker.accept(seq, timestamp)
+        if not fresh:
+            continue
+
+        if timestamp <= 0 or timestamp > now_ms + FUTURE_TOLERANCE_MS:
+            timestamp = now_ms
+        if isinstance(heartbeat, float):
+            heartbeat = round(heartbeat, 1)
+
+        # POST /heart と同じ経路でストアへ
+        record_sample(device_id, timestamp, heartbeat, hold=fill_active)
+        stored += 1
+    return stored
+
+
+def udp_listener(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    print(f"[UDP] 心拍の受信を開始: {host}:{port}")
+    while True:
+        try:
+            payload, _ = sock.recvfrom(2048)
+            counters["datagrams"] += 1
+            handle_datagram(payload)
+        except Exception as e:
+            print("[UDP ERROR]", e)
+
+
+# ----------------------------------------
+# 📊 GET /ingest_stats（UDP 受信の件数・重複・欠損）
+# ----------------------------------------
+@ingest_api.route('/ingest_stats', methods=['GET'])
+def get_ingest_stats():
+    with trackers_lock:
+        devices = {d: t.stats() for d, t in trackers.items()}
+    return jsonify({
+        "enabled": bool(UDP_PORT),
+        "port": UDP_PORT or None,
+        "datagrams": counters["datagrams"],
+        "malformed": counters["malformed"],
+        "devices": devices
+    })
+
+
+if UDP_PORT:
+    # 複数ワーカーでも同じポートで受けるのは1プロセスだけ（HEART_DB 有効時）
+    heart_db.run_as_leader(
+        lambda: threading.Thread(target=udp_listener, args=(UDP_HOST, UDP_PORT), daemon=True).start()
+    )
@@ -0,0 +1,28 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# ----------------------------------------
+# 大きいレスポンス（心拍の系列など）用の JSON 書き出し
+#   orjson が入っていればそれを使い、無ければ標準の json（区切りを詰めて）
+#   HEART_JSON=stdlib で標準に固定できる（比較・切り分け用）
+# ----------------------------------------
+SERIALIZER = os.environ.get("HEART_JSON", "auto")
+if SERIALIZER == "orjson" and orjson is None:
+    print("[JSON] orjson が見つからないので標準の json を使います")
+if SERIALIZER == "stdlib" or orjson is None:
+    SERIALIZER = "stdlib"
+else:
+    SERIALIZER = "orjson"
+
+
+def dumps(obj):
+    # bytes を返す
+    if SERIALIZER == "orjson":
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
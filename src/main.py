@@ -1,54 +1,49 @@
-from flask import Flask, jsonify, send_from_directory, request
+from flask import Flask, Response, jsonify, send_from_directory, request
 import os
-import json
-import threading
-import csv
 import time  # ← CSV保存に必要
 
-from heart_api import heart_api
+from heart_api import heart_api, read_session, reset_heart_data
+from game_state import game_state
+from heart_store import store, RING_CAPACITY
+from resampled_view import TICK_MS
+from csv_export import stream_export, export_path
+from session_archive import ArchiveWriter, archive_path
+from rollups import TIERS, pick_tier, to_records, to_columns
 from turn_api import turn_api
 from id_api import id_api
-from flask import send_file, jsonify
+from stream_api import stream_api
+from snapshot_api import snapshot_api
+from ingest_api import ingest_api
+from session_api import session_api, SessionStats, DATA_DIR, record as record_session
+from event_bus import bus
+from baseline_stats import tracker as baseline_tracker, MIN_SAMPLES, WINDOW_MS as BASELINE_WINDOW_MS
+from http_cache import conditional_json, cached_json, response_cache
+from storage import load_json_file, save_json_file, update_json_file, file_lock
+from flask import jsonify
 from datetime import datetime, timedelta
 
 app = Flask(__name__, static_folder='static')
 app.register_blueprint(heart_api)
 app.register_blueprint(turn_api)
 app.register_blueprint(id_api)
+app.register_blueprint(stream_api)
+app.register_blueprint(snapshot_api)
+app.register_blueprint(ingest_api)
+app.register_blueprint(session_api)
 
 clients = {}
 id_counter = 1
-file_lock = threading.Lock()
 
 DATA_FILE = 'heart_rates.json'
-GAME_STATUS_FILE = 'game_status.json'
-TURN_FILE = 'turn.json'
 ASSIGNED_FILE = 'assigned_ids.json'
 STATIC_FOLDER = 'static'
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_FILE = os.path.abspath(os.path.join(BASE_DIR, 'heart_rates.json'))
 BASELINE_FILE = os.path.join(BASE_DIR, "baseline.json")
-CONTROL_FILE = "control_mode.json"
-
-
-# -------------------------
-# 共通ヘルパー
-# -------------------------
-def save_json_file(filename, data):
-    with file_lock:
-        with open(filename, 'w') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    print(f"[ファイル書き込み] {filename} -> {data}")
-
-def load_json_file(filename):
-    with file_lock:
-        if os.path.exists(filename):
-            with open(filename) as f:
-                content = f.read().strip()
-                if not content:
-                    return {}
-                return json.loads(content)
-        return {}
+# /get_heart_data で指定できる最大範囲（リングバッファに残っている分まで）
+MAX_WINDOW_MS = RING_CAPACITY * 1000
+# /get_heart_rollup で返す1台あたりの最大点数（段の自動選択に使う）
+ROLLUP_MAX_POINTS = 720
 
 
 @app.route('/start', methods=['POST'])
@@ -97,56 +92,52 @@ def start_game():
         }), 400
 
     # 🟢 baseline揃ったので開始OK
-    game_status = load_json_file(GAME_STATUS_FILE)
-    game_status["running"] = True
-    game_status["game_over"] = False
-    save_json_file(GAME_STATUS_FILE, game_status)
-
-    # ターン初期化
+    # ターン初期化も含めて1回で更新
     ids = sorted(assigned_watch_ids)
-    save_json_file(TURN_FILE, {"current_turn": ids[0] if ids else None})
+    game_state.update(running=True, game_over=False, current_turn=ids[0] if ids else None)
 
     print("[GAME START] baseline完全一致 → 開始")
     return jsonify({"status": "ok", "message": "ゲームを開始しました"})
 
 @app.route('/stop', methods=['POST'])
 def stop_game():
-    # ゲーム状態を読み込む
-    game_status = load_json_file(GAME_STATUS_FILE)
-
     # フラグを更新
-    game_status["running"] = False
-    game_status["game_over"] = True
-    save_json_file(GAME_STATUS_FILE, game_status)
+    game_state.update(running=False, game_over=True)
+
+    # 最後の実測値から停止時刻までの保持区間を閉じる
+    store.close_holds(int(time.time() * 1000))
 
     print("[API] ゲーム停止しました")
     return jsonify({"status": "ok", "message": "ゲームを停止しました"})
 
 @app.route('/status', methods=['GET'])
 def get_status():
-    data = load_json_file(GAME_STATUS_FILE)
-    return jsonify({
-        "running": data.get("running", False),
-        "game_over": data.get("game_over", False)
-    })
+    def build():
+        return {
+            "running": game_state.running,
+            "game_over": game_state.game_over
+        }
+    return conditional_json(build, "status")
+
+@app.route('/cache_stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(response_cache.stats())
 
 @app.route("/get_game_status")
 def get_game_status():
-    status = load_json_file("game_status.json")
-    return jsonify(status)
+    return conditional_json(game_state.status, "status")
 
 @app.route('/reset', methods=['POST'])
 def reset_server():
-    save_json_file(DATA_FILE, {})
-    save_json_file(GAME_STATUS_FILE, {
-        "running": False,
-        "game_over": False,
-        "baseline_mode": False
-    })
-    save_json_file(TURN_FILE, {"current_turn": None})
+    reset_heart_data()
+    # running / ターン / 制御モードは GameState がまとめて初期化
+    game_state.reset()
     save_json_file(ASSIGNED_FILE, {})
     save_json_file(BASELINE_FILE, {})
-    save_json_file(CONTROL_FILE, {"mode": "self_fast"})
+
+    bus.publish("clients", {"count": 0, "ids": {}})
+    bus.publish("baselines", {})
+    bus.publish("resync", {})
 
     print("[API] サーバーデータを完全初期化しました")
     return jsonify({
@@ -158,26 +149,30 @@ def reset_server():
 def assign_id():
     global id_counter
     ip = request.remote_addr
-    assigned_ids = load_json_file(ASSIGNED_FILE)
-    if ip in assigned_ids:
-        device_id = assigned_ids[ip]
-    else:
-        existing_ids = set(assigned_ids.values())
-        while f"watch{id_counter}" in existing_ids:
-            id_counter += 1
-        device_id = f"watch{id_counter}"
-        assigned_ids[ip] = device_id
-        save_json_file(ASSIGNED_FILE, assigned_ids)
+    with file_lock(ASSIGNED_FILE):
+        assigned_ids = load_json_file(ASSIGNED_FILE)
+        if ip in assigned_ids:
+            device_id = assigned_ids[ip]
+        else:
+            existing_ids = set(assigned_ids.values())
+            while f"watch{id_counter}" in existing_ids:
+                id_counter += 1
+            device_id = f"watch{id_counter}"
+            assigned_ids[ip] = device_id
+            save_json_file(ASSIGNED_FILE, assigned_ids)
+            bus.publish("clients", {"count": len(assigned_ids), "ids": assigned_ids})
     clients[ip] = device_id
     return jsonify({"device_id": device_id})
 
 @app.route("/clients")
 def get_clients():
-    assigned_ids = load_json_file(ASSIGNED_FILE)
-    return jsonify({
-        "count": len(assigned_ids),
-        "ids": assigned_ids
-    })
+    def build():
+        assigned_ids = load_json_file(ASSIGNED_FILE)
+        return {
+            "count": len(assigned_ids),
+            "ids": assigned_ids
+        }
+    return conditional_json(build, "clients")
 
 @app.route('/set_turn', methods=['POST'])
 def set_turn():
@@ -185,14 +180,13 @@ def set_turn():
     new_turn = data.get("current_turn")
     if not new_turn:
         return jsonify({"status": "error", "message": "current_turnが必要です"}), 400
-    game_status = load_json_file(GAME_STATUS_FILE)
-    if not game_status.get("running", False):
+    if not game_state.running:
         return jsonify({"status": "error", "message": "ゲームを開始してください"}), 400
 # ゲーム状態チェック削除！！
     assigned_ids = load_json_file(ASSIGNED_FILE)
     if new_turn not in assigned_ids.values():
         return jsonify({"status": "error", "message": "指定されたIDが存在しません"}), 400
-    save_json_file(TURN_FILE, {"current_turn": new_turn})
+    game_state.update(current_turn=new_turn)
     print(f"[API] 管理者操作: ターンを {new_turn} に設定しました")
     return jsonify({"status": "ok", "message": f"{new_turn} に設定しました"})
 
@@ -203,58 +197,77 @@ def reconnect():
     ip = request.remote_addr
     if not reconnect_id:
         return jsonify({"status": "error", "message": "IDが指定されていません"}), 400
-    assigned_ids = load_json_file(ASSIGNED_FILE)
-    existing_ids = set(assigned_ids.values())
-    if reconnect_id in existing_ids and assigned_ids.get(ip) != reconnect_id:
-        id_num = 1
-        while f"watch{id_num}" in existing_ids:
-            id_num += 1
-        reconnect_id = f"watch{id_num}"
-    clients[ip] = reconnect_id
-    assigned_ids[ip] = reconnect_id
-    save_json_file(ASSIGNED_FILE, assigned_ids)
+    with file_lock(ASSIGNED_FILE):
+        assigned_ids = load_json_file(ASSIGNED_FILE)
+        existing_ids = set(assigned_ids.values())
+        if reconnect_id in existing_ids and assigned_ids.get(ip) != reconnect_id:
+            id_num = 1
+            while f"watch{id_num}" in existing_ids:
+                id_num += 1
+            reconnect_id = f"watch{id_num}"
+        clients[ip] = reconnect_id
+        assigned_ids[ip] = reconnect_id
+        save_json_file(ASSIGNED_FILE, assigned_ids)
+        bus.publish("clients", {"count": len(assigned_ids), "ids": assigned_ids})
     print(f"[API] 再接続: IP {ip} に {reconnect_id} を割り当てました")
     return jsonify({"status": "ok", "message": f"{reconnect_id} を再登録しました", "device_id": reconnect_id})
 
+# ----------------------------------------
+# 💾 GET /export_csv（CSV をストリーミングで送りつつ data/ にも保存）
+#   ?device=watch1,watch2  端末の絞り込み
+#   ?from= / ?to=          時刻(ms)の範囲 [from, to)
+#   ?gzip=1                gzip で送る（会場の Wi-Fi 向け）。Accept-Encoding が gzip なら
+#                          Content-Encoding で送るのでブラウザではそのまま .csv になる
+#                          保存するファイルは .csv.gz
+# ----------------------------------------
 @app.route('/export_csv')
 def export_csv():
     # ゲームが終了していない場合は保存させない
-    game_status = load_json_file("game_status.json")  # 必要に応じてファイル名調整
-    if game_status.get("running", True):
+    if game_state.running:
         return jsonify({"status": "error", "message": "ゲーム終了後のみCSV保存可能です"}), 403
 
-    # 保存するデータを読み込み
-    data = load_json_file(DATA_FILE)  # ← ここが保存対象のJSON
-
-    # ファイル名生成と保存先フォルダ
-    timestamp = int(time.time())
-    filename = f"heart_rate_data_{timestamp}.csv"
-    filepath = os.path.join("data", filename)
-    os.makedirs("data", exist_ok=True)
-
-    # 書き込み処理（device_id, timestamp, heartbeat）
-    with open(filepath, mode='w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['device_id', 'timestamp', 'heartbeat'])  # ヘッダー行
-        for device_id, records in data.items():
-            for record in records:
-                writer.writerow([
-                    device_id,
-                    record.get('timestamp', ''),
-                    record.get('heartbeat', '')
-                ])
-
-    print(f"[CSV保存] {filepath} に保存されました")
-
-    # クライアントにファイル送信（ダウンロード）
-    return send_file(filepath, as_attachment=True, download_name="heart_rate_data.csv")
+    device = request.args.get("device")
+    devices = [d for d in device.split(",") if d] if device else None
+    from_ts = request.args.get("from", type=int)
+    to_ts = request.args.get("to", type=int)
+    compress = request.args.get("gzip") in ("1", "true")
+
+    # メモリ上の未書き出し分をログへ反映してから読み込み（DB モードは DB から）
+    session = read_session(devices, from_ts, to_ts)  # ← ここが保存対象（送りながら少しずつ読む）
+
+    # ファイル名生成と保存先フォルダ（名前は ms 単位で、同じ秒に2回出しても重ならない）
+    os.makedirs(DATA_DIR, exist_ok=True)
+    filepath = export_path(DATA_DIR, compress)
+
+    # 書きながら集計と列の収集をして、書き終わったら目録へ追加し、隣に圧縮アーカイブ（.hra）を置く
+    stats = SessionStats()
+    archive = ArchiveWriter()
+
+    # 今夜の baseline もセッションと一緒に目録へ残す（分析はこの値で見る）
+    baselines = load_json_file(BASELINE_FILE)
+
+    def on_complete(path):
+        record_session(path, stats, baselines)
+        archive.write(archive_path(path))
+
+    body = stream_export(
+        session, filepath, compress, from_ts, to_ts,
+        sinks=(stats, archive), on_complete=on_complete
+    )
+    response = Response(body, mimetype="text/csv")
+    download_name = "heart_rate_data.csv"
+    if compress:
+        if request.accept_encodings["gzip"]:
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response.mimetype = "application/gzip"
+            download_name += ".gz"
+    response.headers["Content-Disposition"] = f"attachment; filename={download_name}"
+    return response
 
 @app.route("/get_control_mode")
 def get_control_mode():
-    if os.path.exists(CONTROL_FILE):
-        with open(CONTROL_FILE) as f:
-            return jsonify(json.load(f))
-    return jsonify({"mode": "self_fast"})
+    return conditional_json(lambda: {"mode": game_state.mode}, "control_mode")
 
 @app.route("/set_control_mode", methods=["POST"])
 def set_control_mode():
@@ -285,8 +298,7 @@ def set_control_mode():
             "message": "このモードは2台以上接続されていないと使用できません"
         }), 400
 
-    with open(CONTROL_FILE, "w") as f:
-        json.dump({"mode": mode}, f)
+    game_state.update(mode=mode)
 
     print("[CONTROL MODE]", mode)
     return jsonify({
@@ -295,90 +307,106 @@ def set_control_mode():
         "message": f"{mode} に変更しました"
     })
 
+# ----------------------------------------
+# 📈 GET /get_heart_data（1Hz に補完済みの直近の系列）
+#   ?window_ms= で取得範囲を指定（デフォルト30秒、上限はリングバッファ分）
+#   ?format=columns で端末ごとに {"t": [...], "bpm": [...]} の列の形（既定は点ごとの dict）
+#   ?since=<cursor> を付けると差分だけ返す（毎秒ポーリングするダッシュボード用）
+#     初回は since= （空）で全体と cursor を受け取り、以降は前回の cursor を渡す
+#     {"cursor": 次に渡す値, "full": 全体を返したか,
+#      "devices": {device_id: [新しい・変わった点]}, "latest": {device_id: 保持中の実測値}}
+# ----------------------------------------
+def parse_cursor(value):
+    # cursor = "<イベント id>-<返した最後の秒>"
+    try:
+        event_id, last_sec = value.split("-")
+        return int(event_id), int(last_sec)
+    except ValueError:
+        return None
+
+def delta_from(cursor, window_start):
+    # 前回の cursor 以降に変わった最初の時刻（None なら全体を返す）
+    if cursor is None:
+        return None
+    event_id, last_sec = cursor
+    events, lost = bus.since(event_id)
+    if lost or any(kind == "resync" for _, kind, _ in events):
+        return None
+    from_ts = (last_sec + 1) * TICK_MS
+    # 遅れて届いたサンプル（返し済みの秒に入るもの）があればその秒から返し直す
+    # （まとめて届いた古い分は backfill に一番古い時刻だけ入っている）
+    for _, kind, data in events:
+        if kind == "sample":
+            from_ts = min(from_ts, data["timestamp"] // TICK_MS * TICK_MS)
+        elif kind == "backfill":
+            from_ts = min(from_ts, data["from"] // TICK_MS * TICK_MS)
+    return max(from_ts, window_start)
+
 @app.route('/get_heart_data', methods=['GET'])
 def get_heart_data():
     try:
-        all_data = load_json_file(DATA_FILE)
         now_ms = int(datetime.now().timestamp() * 1000)
-        thirty_sec_ago = now_ms - 30_000
-
-        complemented_data = {}
-
-        for device_id, entries in all_data.items():
-
-            # ---- Get entries from last 30 seconds ----
-            recent_entries = [
-                entry for entry in entries if entry['timestamp'] >= thirty_sec_ago
-            ]
-            recent_entries.sort(key=lambda x: x['timestamp'])
-
-            if not recent_entries:
-                continue
-
-            filled_entries = []
-            last_entry = recent_entries[0]
-            filled_entries.append(last_entry)
-
-            complement_count = 0
-            last_complement_ts = None
-
-            # ---- Fill missing intervals between samples ----
-            for rec in recent_entries[1:]:
-                diff = rec["timestamp"] - last_entry["timestamp"]
-
-                if diff > 1000:
-                    missing_count = diff // 1000 - 1
-                    for i in range(missing_count):
-                        fake_ts = last_entry["timestamp"] + 1000 * (i + 1)
-                        filled_entries.append({
-                            "timestamp": fake_ts,
-                            "heartbeat": last_entry["heartbeat"]
-                        })
-                        complement_count += 1
-                        last_complement_ts = fake_ts
-
-                filled_entries.append(rec)
-                last_entry = rec
-
-            # ---- Fill from last entry to current time (existing logic) ----
-            while last_entry["timestamp"] + 1000 < now_ms - 200:  # 200ms buffer
-                fake_ts = last_entry["timestamp"] + 1000
-                filled_entries.append({
-                    "timestamp": fake_ts,
-                    "heartbeat": last_entry["heartbeat"]
-                })
-                complement_count += 1
-                last_complement_ts = fake_ts
-                last_entry = {
-                    "timestamp": fake_ts,
-                    "heartbeat": last_entry["heartbeat"]
-                }
-
-            # ✅ 追加：もし「最後の時刻」が現在より前なら、それも補完
-            if last_entry["timestamp"] < now_ms - 200:
-                while last_entry["timestamp"] + 1000 <= now_ms:
-                    fake_ts = last_entry["timestamp"] + 1000
-                    filled_entries.append({
-                        "timestamp": fake_ts,
-                        "heartbeat": last_entry["heartbeat"]
-                    })
-                    complement_count += 1
-                    last_complement_ts = fake_ts
-                    last_entry = {
-                        "timestamp": fake_ts,
-                        "heartbeat": last_entry["heartbeat"]
-                    }
-
-            if complement_count > 0:
-                print(f"[補完] {device_id}: reused previous value {last_entry['heartbeat']} {complement_count} times (last at {last_complement_ts})")
-
-            complemented_data[device_id] = filled_entries
-
-        return jsonify(complemented_data)
+        window_ms = request.args.get("window_ms", 30_000, type=int)
+        window_ms = max(1000, min(window_ms, MAX_WINDOW_MS))
+        window_start = now_ms - window_ms
+
+        since = request.args.get("since")
+        fmt = request.args.get("format", "records")
+        # ゲーム中・baseline 取得中だけ最後の実測値を今まで伸ばす（それ以外は実測値の秒まで）
+        fill = game_state.fill_active
+
+        def build():
+            if since is None:
+                # ---- 1Hz のリサンプル済み系列を切り出すだけ（補完はストア側で維持） ----
+                complemented_data = store.resampled_all(window_start, now_ms, fill)
+                return {d: columns.render(fmt) for d, columns in complemented_data.items()}
+
+            # 先に id を取っておく（読み出し中に届いたサンプルは次回にもう一度返す）
+            version = bus.last_id
+            from_ts = delta_from(parse_cursor(since), window_start)
+            full = from_ts is None
+            complemented_data = store.resampled_all(window_start if full else from_ts, now_ms, fill)
+            return {
+                "cursor": f"{version}-{now_ms // TICK_MS}",
+                "full": full,
+                "devices": {d: columns.render(fmt) for d, columns in complemented_data.items()},
+                "latest": {d: sample.as_dict() for d, sample in store.latest_all().items()}
+            }
+
+        # 同じ秒・同じ内容のバージョンなら、何人見ていても作るのは1回だけ
+        return cached_json(build, (bus.version("sample", "backfill", "status"), now_ms // TICK_MS))
 
     except Exception as e:
         print(f"[ERROR] get_heart_data failed: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
+
+# ----------------------------------------
+# 📉 GET /get_heart_rollup（長い区間のグラフ用、10秒 / 1分ごとの min / mean / max）
+#   ?window_ms= 取得範囲（デフォルト1時間）
+#   ?bucket_ms= 段の指定（省略時は点数が ROLLUP_MAX_POINTS 以内になる一番細かい段）
+#   ?format=columns で {"t", "min", "mean", "max", "count"} の列の形
+# ----------------------------------------
+@app.route('/get_heart_rollup', methods=['GET'])
+def get_heart_rollup():
+    try:
+        now_ms = int(datetime.now().timestamp() * 1000)
+        window_ms = max(1000, request.args.get("window_ms", 3_600_000, type=int))
+        bucket_ms = request.args.get("bucket_ms", type=int) or pick_tier(window_ms, ROLLUP_MAX_POINTS)
+        if bucket_ms not in [b for b, _ in TIERS]:
+            return jsonify({"status": "error", "message": f"bucket_ms は {[b for b, _ in TIERS]} のどれかです"}), 400
+
+        render = to_columns if request.args.get("format") == "columns" else to_records
+
+        def build():
+            rows = store.rollup_all(bucket_ms, now_ms - window_ms, now_ms)
+            return {"bucket_ms": bucket_ms, "devices": {d: render(bucket_ms, r) for d, r in rows.items()}}
+
+        return cached_json(build, (bus.version("sample", "backfill", "status"), now_ms // TICK_MS))
+
+    except Exception as e:
+        print(f"[ERROR] get_heart_rollup failed: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @app.route('/')
 def serve_index():
     return send_from_directory(STATIC_FOLDER, 'index.html')
@@ -391,67 +419,81 @@ def set_baseline():
     if not device_id or bpm is None:
         return jsonify({"status": "error", "message": "IDかBPMが不足"}), 400
 
-    path = "baseline_bpm.json"
-    if os.path.exists(path):
-        with open(path, "r") as f:
-            baselines = json.load(f)
-    else:
-        baselines = {}
-
-    baselines[device_id] = bpm
-    with open(path, "w") as f:
-        json.dump(baselines, f, indent=2)
+    update_json_file("baseline_bpm.json", lambda baselines: baselines.update({device_id: bpm}))
 
     print(f"[基準BPM設定] {device_id} → {bpm}")
     return jsonify({"status": "ok", "message": f"{device_id} の基準心拍数を {bpm} に設定"})
 
 @app.route('/start_baseline', methods=['POST'])
 def start_baseline():
-    status = load_json_file(GAME_STATUS_FILE)
-    status["baseline_mode"] = True
-    status["running"] = False
-    status["game_over"] = False
-    save_json_file(GAME_STATUS_FILE, status)
+    game_state.update(baseline_mode=True, running=False, game_over=False)
     print("[GAME] ベースライン取得モード開始")
     return jsonify({"status": "ok", "mode": "baseline"})
 
+# ----------------------------------------
+# baseline の計算（受信時に積んでいる直近 10 秒の推定値を読むだけなので待たない）
+#   ?stat=mean（既定）/ median / trimmed_mean で保存する値を選ぶ
+# ----------------------------------------
+BASELINE_STATS = ("mean", "median", "trimmed_mean")
+
+def _baseline_stat():
+    stat = request.args.get("stat", "mean")
+    return stat if stat in BASELINE_STATS else None
+
+def _save_baselines(values):
+    def save_baseline(baseline):
+        baseline.update(values)
+        return dict(baseline)
+    bus.publish("baselines", update_json_file(BASELINE_FILE, save_baseline))
+
 @app.route('/calculate_baseline/<device_id>', methods=['POST'])
 def calculate_baseline(device_id):
+    stat = _baseline_stat()
+    if stat is None:
+        return jsonify({"error": f"stat は {' / '.join(BASELINE_STATS)} のどれかです"}), 400
 
-    time.sleep(1.2)
-
-    data_file = load_json_file(DATA_FILE)
-    records = data_file.get(device_id, [])
+    estimate = baseline_tracker.estimate(device_id, int(time.time() * 1000))
+    if estimate["samples"] < MIN_SAMPLES:
+        return jsonify({"error": f"最低{MIN_SAMPLES}件必要", "samples": estimate["samples"]}), 400
 
-    now = int(time.time() * 1000)
-    ten_sec_ago = now - 10000
+    avg = estimate[stat]
+    print(f"[BASELINE OK] {device_id} {stat}={avg} samples={estimate['samples']}")
 
-    recent = [
-        r["heartbeat"]
-        for r in records
-        if r["timestamp"] >= ten_sec_ago
-    ]
+    # 🔴🔴🔴ここが最重要🔴🔴🔴
+    _save_baselines({device_id: avg})
+    print(f"[BASELINE SAVE] {device_id} -> {avg}")
 
-    if len(recent) < 5:
-        return jsonify({"error":"最低5件必要"}),400
+    return jsonify(dict(estimate, average=avg))
 
-    avg = sum(recent) / len(recent)
+@app.route('/baseline_estimates', methods=['GET'])
+def get_baseline_estimates():
+    # 全端末の現在の推定値と件数（保存はしない）
+    return jsonify({
+        "baseline_mode": game_state.baseline_mode,
+        "window_ms": BASELINE_WINDOW_MS,
+        "devices": baseline_tracker.estimates(int(time.time() * 1000))
+    })
 
-    print(f"[BASELINE OK] {device_id} avg={avg} samples={len(recent)}")
+@app.route('/calculate_baselines', methods=['POST'])
+def calculate_baselines():
+    # 全端末まとめて保存（件数が足りない端末は skipped に入れて保存しない）
+    stat = _baseline_stat()
+    if stat is None:
+        return jsonify({"error": f"stat は {' / '.join(BASELINE_STATS)} のどれかです"}), 400
 
-    # 🔴🔴🔴ここが最重要🔴🔴🔴
-    baseline = load_json_file(BASELINE_FILE)
-    baseline[device_id] = avg
-    save_json_file(BASELINE_FILE, baseline)
-    print(f"[BASELINE SAVE] {device_id} -> {avg}")
+    estimates = baseline_tracker.estimates(int(time.time() * 1000))
+    saved = {d: e[stat] for d, e in estimates.items() if e["samples"] >= MIN_SAMPLES}
+    skipped = {d: e["samples"] for d, e in estimates.items() if e["samples"] < MIN_SAMPLES}
+    if saved:
+        _save_baselines(saved)
+        print(f"[BASELINE SAVE] {stat}: {saved}")
 
-    return jsonify({"average":avg})
+    return jsonify({"stat": stat, "saved": saved, "skipped": skipped, "devices": estimates})
 
 @app.route('/stop_baseline', methods=['POST'])
 def stop_baseline():
-    status = load_json_file(GAME_STATUS_FILE)
-    status["baseline_mode"] = False
-    save_json_file(GAME_STATUS_FILE, status)
+    game_state.update(baseline_mode=False)
+    store.close_holds(int(time.time() * 1000))
     print("[GAME] ベースライン取得モード終了")
     return jsonify({"status": "ok", "mode": "normal"})
 
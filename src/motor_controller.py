@@ -4,6 +4,7 @@ import time
 import requests
 import threading
 import random
+import json
 
 # --------------------
 # 設定
@@ -13,10 +14,8 @@ stepsPerRevolution = 2048
 MIN_STEPSPEED = 0.003
 
 API_HOST = 'http://192.168.100.26:8080'
-HEART_API_URL = f'{API_HOST}/heart_all'  # ★全watchの心拍を取得するAPI
-STATUS_API_URL = f'{API_HOST}/status'
-TURN_API_URL = f'{API_HOST}/turn'
-BASELINE_API_URL = f'{API_HOST}/get_baselines'   # ★追加
+SNAPSHOT_API_URL = f'{API_HOST}/snapshot'       # ★状態をまとめて取得するAPI
+STATE_STREAM_URL = f'{API_HOST}/state_stream'    # ★状態の push チャネル
 
 rotation_settings = {}
 rotation_settings_lock = threading.Lock()
@@ -33,6 +32,11 @@ baseline_lock = threading.Lock()
 random_target_map = {}
 random_target_lock = threading.Lock()
 
+# /state_stream から受け取ったサーバー状態
+server_state = {}
+server_state_lock = threading.Lock()
+last_turn = None
+
 # --------------------
 # GPIOセットアップ
 # --------------------
@@ -95,104 +99,36 @@ def calculate_direction(diff):
 # --------------------
 # API通信
 # --------------------
-def get_game_status():
-    try:
-        res = requests.get(STATUS_API_URL, timeout=2)
-        res.raise_for_status()
-        return res.json().get("running", False)
-    except Exception as e:
-        print("[ERROR] /status取得失敗:", e)
-        return False
-
-def get_current_turn():
-    try:
-        res = requests.get(TURN_API_URL, timeout=2)
-        res.raise_for_status()
-        return res.json().get("current_turn")
-    except Exception as e:
-        print("[ERROR] /turn取得失敗:", e)
-        return None
-
-def get_heart_data():
-    try:
-        res = requests.get(HEART_API_URL, timeout=2)
-        res.raise_for_status()
-        return res.json()
-    except Exception as e:
-        print("[ERROR] /heart取得失敗:", e)
-        return {}
-
-def fetch_baselines():
+def fetch_snapshot(etag=None):
     """
-    baseline.json をサーバから取得してキャッシュ更新
+    /snapshot を1回だけ取得（状態・ターン・baseline・心拍などがまとめて返る）
+    戻り値: (snapshot, etag)。etag と変わっていなければ snapshot は None（304）
     """
-    try:
-        res = requests.get(BASELINE_API_URL, timeout=2)
-        res.raise_for_status()
-        data = res.json()  # {"watch1": 68.2, ...}
-
-        # 数値化して保存
-        parsed = {}
-        for k, v in data.items():
-            try:
-                parsed[k] = float(v)
-            except:
-                pass
-
-        with baseline_lock:
-            baseline_cache.clear()
-            baseline_cache.update(parsed)
-
-        # print("[BASELINE] updated:", baseline_cache)
-    except Exception as e:
-        # 失敗しても前のキャッシュで動かす
-        print("[WARN] baseline取得失敗（キャッシュ継続）:", e)
-
-def get_control_mode():
-    try:
-        res = requests.get(f"{API_HOST}/get_control_mode", timeout=2)
-        res.raise_for_status()
-        return res.json().get("mode","self")
-    except:
-        return "self"
+    headers = {} if etag is None else {"If-None-Match": etag}
+    res = requests.get(SNAPSHOT_API_URL, headers=headers, timeout=2)
+    if res.status_code == 304:
+        return None, etag
+    res.raise_for_status()
+    return res.json(), res.headers.get("ETag")
 
 # --------------------
 # 次のwatch取得
 # --------------------
-def get_watch_ids():
-    try:
-        res = requests.get(f"{API_HOST}/clients", timeout=2)
-        res.raise_for_status()
-        data = res.json()
-
-        ids = list(data.get("ids", {}).values())
-        ids = sorted(set(ids))  # ["watch1","watch2"...]
-        return ids
-    except Exception as e:
-        print("[ERROR] /clients取得失敗:", e)
-        return []
-
-def get_next_watch(current_turn):
-    ids = get_watch_ids()
-
+def get_next_watch(current_turn, ids):
     if not current_turn or current_turn not in ids:
         return None
 
     i = ids.index(current_turn)
     return ids[(i + 1) % len(ids)]
 
-def get_prev_watch(current_turn):
-    ids = get_watch_ids()
-
+def get_prev_watch(current_turn, ids):
     if not current_turn or current_turn not in ids:
         return None
 
     i = ids.index(current_turn)
     return ids[(i - 1) % len(ids)]
 
-def get_random_watch(current_turn):
-    ids = get_watch_ids()
-
+def get_random_watch(current_turn, ids):
     if not current_turn or current_turn not in ids:
         return None
 
@@ -214,101 +150,182 @@ def get_random_watch(current_turn):
         return target
 
 # --------------------
-# データ取得スレッド
+# 状態 → 回転設定
 # --------------------
-def data_fetch_loop():
-    last_turn = None
-    last_info = 0
-
-    while True:
+def update_baselines(data):
+    # 数値化してキャッシュ更新
+    parsed = {}
+    for k, v in data.items():
         try:
-            running = get_game_status()
-            if not running:
-                with rotation_settings_lock:
-                    rotation_settings.clear()
+            parsed[k] = float(v)
+        except:
+            pass
 
-                # ★追加：2秒に1回だけ表示（うるさくしない）
-                if time.time() - last_info > 2:
-                    print("[WAIT] game running=false なので待機中…（UIでゲーム開始してね）")
-                    last_info = time.time()
+    with baseline_lock:
+        baseline_cache.clear()
+        baseline_cache.update(parsed)
 
-                time.sleep(1)
-                continue
+def apply_state(running, current_turn, heart_data, mode, ids):
+    """
+    heart_data: {"watch1": bpm, ...}
+    rpm と方向を計算して rotation_settings を更新する
+    """
+    global last_turn
+
+    if not running:
+        with rotation_settings_lock:
+            rotation_settings.clear()
+        return
+
+    # ターン変化ログ
+    if current_turn != last_turn:
+        print(f"[TURN] {last_turn} -> {current_turn}")
+
+        with random_target_lock:
+            if last_turn in random_target_map:
+                del random_target_map[last_turn]
+
+        last_turn = current_turn
+
+    if not current_turn or current_turn not in heart_data:
+        with rotation_settings_lock:
+            rotation_settings.clear()
+        return
+
+    # 参照する心拍のwatchを決める
+    if mode == "self_fast" or mode == "self_slow":
+        target_watch = current_turn
+    elif mode == "next_fast":
+        target_watch = get_next_watch(current_turn, ids)
+    elif mode == "prev_fast":
+        target_watch = get_prev_watch(current_turn, ids)
+    elif mode == "random_fast":
+        target_watch = get_random_watch(current_turn, ids)
+    else:
+        target_watch = current_turn
 
-            # baseline更新（毎秒でOK、重いなら2～3秒にしても良い）
-            fetch_baselines()
+    if not target_watch or target_watch not in heart_data:
+        with rotation_settings_lock:
+            rotation_settings.clear()
+        return
 
-            current_turn = get_current_turn()
-            heart_data = get_heart_data()
-            # ターン変化ログ
-            if current_turn != last_turn:
-                print(f"[TURN] {last_turn} -> {current_turn}")
+    try:
+        bpm = float(heart_data.get(target_watch, 0))
+    except (ValueError, TypeError):
+        bpm = 0
 
-                with random_target_lock:
-                    if last_turn in random_target_map:
-                        del random_target_map[last_turn]
+    # baselineは「参照する心拍のwatch」に合わせる（★重要）
+    with baseline_lock:
+        baseline = baseline_cache.get(target_watch)
 
-                last_turn = current_turn
+    if baseline is None:
+        print(f"[WARN] baseline無し: target={target_watch} （モーター停止）")
+        with rotation_settings_lock:
+            rotation_settings.clear()
+        return
 
-            if not current_turn or current_turn not in heart_data:
-                with rotation_settings_lock:
-                    rotation_settings.clear()
-                time.sleep(1)
-                continue
+    diff = bpm - baseline
 
-            mode = get_control_mode()
-
-            # 参照する心拍のwatchを決める
-            if mode == "self_fast" or mode == "self_slow":
-                target_watch = current_turn
-            elif mode == "next_fast":
-                target_watch = get_next_watch(current_turn)
-            elif mode == "prev_fast":
-                target_watch = get_prev_watch(current_turn)
-            elif mode == "random_fast":
-                target_watch = get_random_watch(current_turn)
-            else:
-                target_watch = current_turn
-
-            if not target_watch or target_watch not in heart_data:
-                with rotation_settings_lock:
-                    rotation_settings.clear()
-                time.sleep(1)
-                continue
+    if mode == "self_slow":
+        rpm = calculate_rpm_slow(diff)
+    else:
+        rpm = calculate_rpm_fast(diff)
 
-            record = heart_data.get(target_watch, {})
-            try:
-                bpm = float(record.get("heartbeat", 0))
-            except (ValueError, TypeError):
-                bpm = 0
+    direction = calculate_direction(diff)
 
-            # baselineは「参照する心拍のwatch」に合わせる（★重要）
-            with baseline_lock:
-                baseline = baseline_cache.get(target_watch)
+    # ★回転させる対象は「今ターンの人」（プレイ中の人）
+    with rotation_settings_lock:
+        rotation_settings.clear()
+        if rpm > 0:
+            rotation_settings[current_turn] = (rpm, direction)
 
-            if baseline is None:
-                print(f"[WARN] baseline無し: target={target_watch} （モーター停止）")
-                with rotation_settings_lock:
-                    rotation_settings.clear()
+    print(f"[心拍] mode={mode} motor={current_turn} uses={target_watch}: bpm={bpm:.1f}, base={baseline:.1f}, diff={diff:+.1f} -> rpm={rpm}, dir={direction}")
+
+# --------------------
+# 状態受信スレッド（push）
+# --------------------
+def handle_state_message(message):
+    with server_state_lock:
+        if message.get("type") == "state":
+            server_state.clear()
+        heart = message.pop("heart", None)
+        if heart is not None:
+            server_state.setdefault("heart", {}).update(heart)
+        server_state.update(message)
+
+        if "baselines" in message:
+            update_baselines(message["baselines"])
+
+        running = server_state.get("running", False)
+        current_turn = server_state.get("current_turn")
+        heart_data = dict(server_state.get("heart", {}))
+        mode = server_state.get("mode", "self_fast")
+        ids = list(server_state.get("ids", []))
+
+    # 変化が届いたらすぐに rpm と方向を計算し直す
+    apply_state(running, current_turn, heart_data, mode, ids)
+
+def state_stream_loop():
+    while True:
+        try:
+            with requests.get(STATE_STREAM_URL, stream=True, timeout=(3, 30)) as res:
+                if res.status_code == 404:
+                    # ストリームが使えない環境なら /snapshot のポーリングで動かす
+                    print("[STREAM] /state_stream が無いのでポーリングに切り替えます")
+                    data_fetch_loop()
+                    return
+                res.raise_for_status()
+                print("[STREAM] 接続しました")
+
+                for line in res.iter_lines(decode_unicode=True):
+                    if not line:
+                        continue  # keepalive
+                    handle_state_message(json.loads(line))
+
+        except Exception as e:
+            print("[ERROR] 状態ストリーム切断:", e)
+
+        # 切断中はモーターを止めて再接続
+        with rotation_settings_lock:
+            rotation_settings.clear()
+        time.sleep(1)
+
+# --------------------
+# データ取得スレッド（ポーリング、ストリームが使えない時用）
+# --------------------
+def data_fetch_loop():
+    last_info = 0
+    etag = None
+
+    while True:
+        try:
+            snapshot, etag = fetch_snapshot(etag)
+            if snapshot is None:
+                # 前回から何も変わっていない
                 time.sleep(1)
                 continue
 
-            diff = bpm - baseline
+            running = snapshot.get("running", False)
+            if not running:
+                apply_state(False, None, {}, None, [])
+
+                # ★追加：2秒に1回だけ表示（うるさくしない）
+                if time.time() - last_info > 2:
+                    print("[WAIT] game running=false なので待機中…（UIでゲーム開始してね）")
+                    last_info = time.time()
 
-            if mode == "self_slow":
-                rpm = calculate_rpm_slow(diff)
-            else:
-                rpm = calculate_rpm_fast(diff)
+                time.sleep(1)
+                continue
 
-            direction = calculate_direction(diff)
+            update_baselines(snapshot.get("baselines", {}))
 
-            # ★回転させる対象は「今ターンの人」（プレイ中の人）
-            with rotation_settings_lock:
-                rotation_settings.clear()
-                if rpm > 0:
-                    rotation_settings[current_turn] = (rpm, direction)
+            heart_data = {
+                device_id: record.get("heartbeat", 0)
+                for device_id, record in snapshot.get("latest", {}).items()
+            }
+            ids = sorted(set(snapshot.get("clients", {}).get("ids", {}).values()))
 
-            print(f"[心拍] mode={mode} motor={current_turn} uses={target_watch}: bpm={bpm:.1f}, base={baseline:.1f}, diff={diff:+.1f} -> rpm={rpm}, dir={direction}")
+            apply_state(True, snapshot.get("current_turn"), heart_data, snapshot.get("mode", "self_fast"), ids)
 
             time.sleep(1)
 
@@ -352,5 +369,5 @@ def rotation_loop():
 if __name__ == '__main__':
     print("[START] Motor controller starting up...")
     setup_motor()
-    threading.Thread(target=data_fetch_loop, daemon=True).start()
+    threading.Thread(target=state_stream_loop, daemon=True).start()
     rotation_loop()
\ No newline at end of file
@@ -0,0 +1,183 @@
+import heapq
+import os
+from itertools import chain
+from array import array
+
+from samples import Columns
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+TICK_MS = 1000
+# 最後の実測値をこれより長くは保持しない（ms）。途切れた端末を平らな線で出し続けないため
+MAX_HOLD_MS = int(os.environ.get("HEART_MAX_HOLD_MS", "30000"))
+MAX_HOLD_SEC = MAX_HOLD_MS // TICK_MS
+# これより長い区間を作り直すときは NumPy でまとめて計算する
+VECTORIZE_THRESHOLD = 256
+
+
+# ----------------------------------------
+# 1秒グリッドへのリサンプル（前方補完）
+#   各秒の値 = その秒の終わりまでに届いた最新の値（MAX_HOLD_SEC より古ければ値なし）
+# ----------------------------------------
+def resample(samples, from_sec, to_sec):
+    # samples: 時刻順の [(timestamp, heartbeat), ...]
+    count = to_sec - from_sec + 1
+    if count <= 0:
+        return []
+
+    if np is not None and count >= VECTORIZE_THRESHOLD and samples:
+        ts = np.fromiter((t for t, _ in samples), dtype=np.int64, count=len(samples))
+        hb = np.empty(len(samples), dtype=object)
+        hb[:] = [h for _, h in samples]
+        ends = (np.arange(from_sec, to_sec + 1, dtype=np.int64) + 1) * TICK_MS
+        idx = np.searchsorted(ts, ends, side='left') - 1
+        values = hb[np.maximum(idx, 0)]
+        age = np.arange(from_sec, to_sec + 1, dtype=np.int64) - ts[np.maximum(idx, 0)] // TICK_MS
+        values[(idx < 0) | (age > MAX_HOLD_SEC)] = None
+        return values.tolist()
+
+    values = []
+    current = None
+    current_sec = None
+    j = 0
+    for sec in range(from_sec, to_sec + 1):
+        end = (sec + 1) * TICK_MS
+        while j < len(samples) and samples[j][0] < end:
+            current_sec, current = samples[j][0] // TICK_MS, samples[j][1]
+            j += 1
+        values.append(current if current_sec is not None and sec - current_sec <= MAX_HOLD_SEC else None)
+    return values
+
+
+# ----------------------------------------
+# 保持区間の展開（CSV出力など、補完値の行が必要な時だけ読み出し時に作る）
+#   holds: [(from, until, heartbeat), ...] → from+1s, from+2s, ... < until
+#   samples は時刻順であること。行は1行ずつ作って返す（全体のリストは作らない）
+# ----------------------------------------
+def _hold_rows(start, until, heartbeat):
+    for ts in range(start + TICK_MS, until, TICK_MS):
+        yield ts, heartbeat
+
+def expand_holds(samples, holds):
+    # samples / holds はどちらも時刻順のイテレーター（保持区間は重ならないので順に展開してつなげる）
+    # 同じ時刻なら実測値を先に（heapq.merge は前の引数を優先する）
+    held = chain.from_iterable(_hold_rows(*h) for h in holds)
+    return heapq.merge(samples, held, key=lambda r: r[0])
+
+
+MISSING = float("nan")
+
+
+# ----------------------------------------
+# デバイス1台分の 1Hz リサンプル済み系列（リングバッファ）
+#   値は float32 の array、まだ値が無い秒・保持が切れた秒は NaN
+# ----------------------------------------
+class ResampledSeries:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.values = array('f', [MISSING]) * capacity
+        self.start = 0
+        self.size = 0
+        # 論理インデックス0に対応する秒
+        self.base_sec = None
+        # 最後の実測値の秒（ここから MAX_HOLD_SEC までだけ保持して伸ばす）
+        self.last_sec = None
+
+    @property
+    def end_sec(self):
+        return self.base_sec + self.size - 1
+
+    def _index(self, n):
+        return (self.start + n) % self.capacity
+
+    def _push(self, value):
+        self.values[self._index(self.size)] = MISSING if value is None else value
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+            self.base_sec += 1
+
+    def last(self):
+        if self.size == 0:
+            return MISSING
+        return self.values[self._index(self.size - 1)]
+
+    def advance(self, sec):
+        # 時間が進んだ分だけ直前の値を保持して伸ばす（MAX_HOLD_SEC を過ぎた秒は NaN）
+        if self.base_sec is None or sec <= self.end_sec:
+            return
+        value = self.last()
+        first = self.end_sec + 1
+        if sec - self.end_sec >= self.capacity:
+            self.start = 0
+            self.size = 0
+            self.base_sec = first = sec - self.capacity + 1
+        held_until = -1 if self.last_sec is None else self.last_sec + MAX_HOLD_SEC
+        for n in range(first, sec + 1):
+            self._push(value if n <= held_until else MISSING)
+
+    def add(self, timestamp, heartbeat):
+        # 追記できたら True、過去の秒に届いたサンプルなら False（作り直しが必要）
+        sec = timestamp // TICK_MS
+        if self.base_sec is None:
+            self.base_sec = self.last_sec = sec
+            self._push(heartbeat)
+            return True
+        if sec < self.end_sec:
+            return False
+        self.advance(sec)
+        self.values[self._index(self.size - 1)] = heartbeat
+        self.last_sec = sec
+        return True
+
+    def rebuild(self, samples, from_sec, to_sec):
+        # from_sec 以降を samples から作り直す（samples は from_sec 直前の1件を含むこと）
+        if self.base_sec is None or from_sec <= self.base_sec:
+            from_sec = max(from_sec, to_sec - self.capacity + 1)
+            self.start = 0
+            self.size = 0
+            self.base_sec = from_sec
+        else:
+            # 末尾より先から始まる分（Wi-Fi 切れの後のまとめ送信など）は
+            # 間の秒も埋めるように末尾の次の秒から作る
+            from_sec = min(from_sec, self.end_sec + 1)
+            self.size = from_sec - self.base_sec
+        if samples:
+            self.last_sec = samples[-1][0] // TICK_MS
+        for value in resample(samples, from_sec, to_sec):
+            self._push(value)
+
+    def slice(self, from_sec, to_sec):
+        if self.base_sec is None:
+            return Columns()
+        lo = max(from_sec, self.base_sec) - self.base_sec
+        hi = min(to_sec, self.end_sec) - self.base_sec + 1
+        result = Columns()
+        for n in range(lo, hi):
+            value = self.values[self._index(n)]
+            if value == value:
+                result.timestamps.append((self.base_sec + n) * TICK_MS)
+                result.heartbeats.append(value)
+        return result
+
+
+if __name__ == "__main__":
+    # python resampled_view.py : 末尾から離れた所から始まるまとめ送信の確認
+    view = ResampledSeries(60)
+    for sec in range(100, 105):
+        view.add(sec * TICK_MS, 70 + sec - 100)
+    batch = [(sec * TICK_MS, 90 + sec - 120) for sec in range(120, 125)]
+    view.rebuild([(104 * TICK_MS, 74)] + batch, 120, 124)
+    got = dict(zip((t // TICK_MS for t in view.slice(100, 124).timestamps), view.slice(100, 124).heartbeats))
+    assert [got[sec] for sec in range(120, 125)] == [90, 91, 92, 93, 94], got
+    assert all(got[sec] == 74 for sec in range(105, 120)), got
+    # 最後の実測値から MAX_HOLD_SEC を過ぎた秒は伸ばさない
+    view.advance(124 + MAX_HOLD_SEC + 5)
+    held = view.slice(125, 124 + MAX_HOLD_SEC + 5).timestamps
+    assert held[-1] // TICK_MS == 124 + MAX_HOLD_SEC, held[-1]
+    print("[CHECK] resampled_view OK")
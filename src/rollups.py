@@ -0,0 +1,154 @@
+import os
+from array import array
+
+from samples import bpm_value
+
+
+# ----------------------------------------
+# 保持期間の設定
+#   HEART_RAW_RETENTION_MIN: メモリに置く生サンプルの分数（1Hz 換算でリングの容量になる）
+#   HEART_LOG_RETENTION_MIN: サンプルログ / DB に残す生サンプルの分数
+#                            （0 なら全部残す。CSV はセッション全体を出すので既定は 0）
+#   HEART_ROLLUP_TIERS:      集計の段 "バケット秒:保持分" をカンマ区切り
+#                            既定 "10:360,60:1440" = 10秒ごとを6時間、1分ごとを24時間
+# ----------------------------------------
+RAW_RETENTION_MIN = int(os.environ.get("HEART_RAW_RETENTION_MIN", "120"))
+LOG_RETENTION_MS = int(os.environ.get("HEART_LOG_RETENTION_MIN", "0")) * 60_000
+
+
+def parse_tiers(spec):
+    # "10:360,60:1440" → [(10000, 2160), (60000, 1440)]（バケット ms, バケット数）
+    tiers = []
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        bucket_sec, keep_min = (int(v) for v in item.split(":"))
+        tiers.append((bucket_sec * 1000, keep_min * 60 // bucket_sec))
+    return sorted(tiers)
+
+TIERS = parse_tiers(os.environ.get("HEART_ROLLUP_TIERS", "10:360,60:1440"))
+
+
+# ----------------------------------------
+# デバイス1台・1段分の集計リングバッファ
+#   バケットごとに 件数 / 合計 / 最小 / 最大 を持つ（平均は読み出し時に 合計 / 件数）
+#   サンプルが届くたびに該当バケットだけを更新する
+# ----------------------------------------
+class RollupRing:
+    def __init__(self, bucket_ms, capacity):
+        self.bucket_ms = bucket_ms
+        self.capacity = capacity
+        self.buckets = array('q', bytes(8 * capacity))
+        self.counts = array('q', bytes(8 * capacity))
+        self.sums = array('d', bytes(8 * capacity))
+        self.mins = array('f', bytes(4 * capacity))
+        self.maxs = array('f', bytes(4 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def _index(self, n):
+        return (self.start + n) % self.capacity
+
+    def bisect_left(self, bucket):
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.buckets[self._index(mid)] < bucket:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def add(self, timestamp, heartbeat):
+        self.merge(timestamp // self.bucket_ms, 1, heartbeat, heartbeat, heartbeat)
+
+    def merge(self, bucket, count, total, low, high):
+        # 集計済みの値（スナップショットからの復元など）もそのまま足し込める
+        if self.size:
+            last = self._index(self.size - 1)
+            if bucket == self.buckets[last]:
+                self._update(last, count, total, low, high)
+                return
+            if bucket < self.buckets[last]:
+                # 遅れて届いたサンプル：既存のバケットがあればそこへ足す
+                n = self.bisect_left(bucket)
+                if n < self.size and self.buckets[self._index(n)] == bucket:
+                    self._update(self._index(n), count, total, low, high)
+                    return
+                if self.size == self.capacity and n == 0:
+                    # 保持範囲より古い
+                    return
+        self._push(bucket, count, total, low, high)
+
+    def _update(self, i, count, total, low, high):
+        self.counts[i] += count
+        self.sums[i] += total
+        self.mins[i] = min(self.mins[i], low)
+        self.maxs[i] = max(self.maxs[i], high)
+
+    def _push(self, bucket, count, total, low, high):
+        end = self._index(self.size)
+        self.buckets[end] = bucket
+        self.counts[end] = count
+        self.sums[end] = total
+        self.mins[end] = low
+        self.maxs[end] = high
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+        # バケット順を保つ（DeviceRing.append と同じく後ろから入れ替える）
+        columns = (self.buckets, self.counts, self.sums, self.mins, self.maxs)
+        n = self.size - 1
+        while n > 0:
+            cur, prev = self._index(n), self._index(n - 1)
+            if self.buckets[prev] <= self.buckets[cur]:
+                break
+            for col in columns:
+                col[prev], col[cur] = col[cur], col[prev]
+            n -= 1
+
+    def rows(self, from_ts=None, to_ts=None):
+        # [(バケット, 件数, 合計, 最小, 最大), ...]（[from_ts, to_ts) に掛かるバケット）
+        lo = 0 if from_ts is None else self.bisect_left(from_ts // self.bucket_ms)
+        hi = self.size if to_ts is None else self.bisect_left(-(-to_ts // self.bucket_ms))
+        result = []
+        for n in range(lo, hi):
+            i = self._index(n)
+            result.append((self.buckets[i], self.counts[i], self.sums[i], self.mins[i], self.maxs[i]))
+        return result
+
+
+def make_rings():
+    return [RollupRing(bucket_ms, capacity) for bucket_ms, capacity in TIERS]
+
+def pick_tier(window_ms, max_points):
+    # 点数が max_points 以内に収まる一番細かい段（無ければ一番粗い段）
+    for bucket_ms, _ in TIERS:
+        if window_ms // bucket_ms <= max_points:
+            return bucket_ms
+    return TIERS[-1][0] if TIERS else None
+
+def to_columns(bucket_ms, rows):
+    # ?format=columns 用（列ごとの配列）
+    return {
+        "t": [bucket * bucket_ms for bucket, *_ in rows],
+        "min": [bpm_value(low) for _, _, _, low, _ in rows],
+        "mean": [round(total / count, 1) for _, count, total, _, _ in rows],
+        "max": [bpm_value(high) for *_, high in rows],
+        "count": [count for _, count, *_ in rows]
+    }
+
+def to_records(bucket_ms, rows):
+    # API 用の形（timestamp はバケットの開始時刻）
+    return [
+        {
+            "timestamp": bucket * bucket_ms,
+            "min": bpm_value(low),
+            "mean": round(total / count, 1),
+            "max": bpm_value(high),
+            "count": count
+        }
+        for bucket, count, total, low, high in rows
+    ]
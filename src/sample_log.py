@@ -0,0 +1,455 @@
+import heapq
+import json
+import os
+import threading
+import time
+
+from rollups import RollupRing, TIERS, LOG_RETENTION_MS, RAW_RETENTION_MIN
+from samples import bpm_value
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_DIR = os.path.join(BASE_DIR, 'sample_log')
+SNAPSHOT_FILE = 'snapshot.json'
+# 圧縮済みのセグメントを移す先（CSV 出力用の生データ。追記のみで書き換えない）
+ARCHIVE_DIR = 'archive'
+
+# 1セグメントあたりの最大レコード数（4台×1Hzで約15分）
+SEGMENT_MAX_RECORDS = 3600
+# 閉じたセグメントがこの数以上たまったらスナップショットへ畳み込む
+COMPACT_THRESHOLD = 2
+COMPACT_INTERVAL = 30
+# スナップショットに生サンプルで残す幅（ストアのリングと同じ。それより古い分は集計だけ残す）
+HOT_WINDOW_MS = RAW_RETENTION_MIN * 60_000
+
+
+def _segment_name(index):
+    return f"segment_{index:06d}.jsonl"
+
+def _segment_index(name):
+    return int(name[len("segment_"):-len(".jsonl")])
+
+def _encode(record):
+    rec = {"d": record[0], "t": record[1], "h": record[2]}
+    if len(record) > 3:
+        rec["u"] = record[3]
+    return json.dumps(rec, separators=(",", ":")) + "\n"
+
+def _empty_snapshot():
+    return {
+        "last_segment": 0,
+        "devices": {},
+        # ストアの復元用：スナップショットの生サンプルより古い分の集計
+        "rollups": {},
+        # DB への取り込み用：保持期間を過ぎてアーカイブから消した分の集計
+        "pruned_rollups": {},
+        # アーカイブの索引 {ファイル名: {device_id: [最初の時刻, 最後の時刻]}}
+        "archive": {}
+    }
+
+def _fold(tiers, rows):
+    # (timestamp, heartbeat) を段ごとの集計 {bucket_ms(str): [row, ...]} へ足し込む
+    for bucket_ms, capacity in TIERS:
+        ring = RollupRing(bucket_ms, capacity)
+        for row in tiers.get(str(bucket_ms), []):
+            ring.merge(*row)
+        for ts, hb in rows:
+            ring.add(ts, hb)
+        tiers[str(bucket_ms)] = [
+            [bucket, count, total, bpm_value(low), bpm_value(high)]
+            for bucket, count, total, low, high in ring.rows()
+        ]
+
+def _merge_range(ranges, device_id, start, end):
+    r = ranges.get(device_id)
+    if r is None:
+        ranges[device_id] = [start, end]
+    else:
+        r[0] = min(r[0], start)
+        r[1] = max(r[1], end)
+
+
+# ----------------------------------------
+# 追記専用のサンプルログ（1行1サンプルの JSON Lines）
+#   実測値:   {"d": device_id, "t": timestamp, "h": heartbeat}
+#   保持区間: {"d": device_id, "t": from, "h": heartbeat, "u": until}
+#             （t〜u の間は h を保持していた、という印。補完値そのものは保存しない）
+#
+#   起動時に読むのはスナップショット（直近 HOT_WINDOW_MS の生サンプル + 集計）と
+#   未圧縮のセグメントだけなので、セッションが長くなっても復元にかかる時間は変わらない
+#   CSV 出力はアーカイブ（圧縮済みセグメント）+ 未圧縮のセグメントを読む
+# ----------------------------------------
+class SampleLog:
+    def __init__(self, directory=LOG_DIR, segment_max_records=SEGMENT_MAX_RECORDS):
+        self.directory = directory
+        self.archive_dir = os.path.join(directory, ARCHIVE_DIR)
+        self.segment_max_records = segment_max_records
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._file = None
+        self._active = 0
+        self._active_records = 0
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+    # ---- ファイル一覧 ----
+    def _segments(self):
+        return self._list(self.directory)
+
+    def _archived(self):
+        return self._list(self.archive_dir)
+
+    def _list(self, directory):
+        names = [
+            n for n in os.listdir(directory)
+            if n.startswith("segment_") and n.endswith(".jsonl")
+        ]
+        return sorted(_segment_index(n) for n in names)
+
+    def _all_segments(self):
+        # アーカイブと未圧縮のセグメントをまとめて番号順に [(番号, パス), ...]
+        paths = [(i, os.path.join(self.archive_dir, _segment_name(i))) for i in self._archived()]
+        paths += [(i, self._path(_segment_name(i))) for i in self._segments()]
+        return sorted(paths)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load_snapshot(self):
+        path = self._path(SNAPSHOT_FILE)
+        if not os.path.exists(path):
+            return _empty_snapshot()
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_snapshot(self, snapshot):
+        # 一時ファイルに書いてから置き換える（途中で落ちても前のスナップショットが残る）
+        path = self._path(SNAPSHOT_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def is_empty(self):
+        return (
+            not self._segments() and not self._archived()
+            and not os.path.exists(self._path(SNAPSHOT_FILE))
+        )
+
+    # ---- 書き込み ----
+    def _open_next_segment(self):
+        if self._file:
+            self._file.close()
+        if self._active == 0:
+            # クラッシュ後の途中行に追記しないよう、起動ごとに新しいセグメントから書く
+            segments = self._segments()
+            snapshot_last = self._load_snapshot()["last_segment"]
+            self._active = max(segments[-1] if segments else 0, snapshot_last)
+        self._active += 1
+        self._active_records = 0
+        self._file = open(self._path(_segment_name(self._active)), 'a')
+
+    def append_many(self, records):
+        # records: [(device_id, timestamp, heartbeat), ...]
+        #          保持区間は (device_id, from, heartbeat, until)
+        if not records:
+            return
+        with self._lock:
+            if self._file is None:
+                self._open_next_segment()
+            lines = [_encode(rec) for rec in records]
+            self._file.write("".join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._active_records += len(lines)
+            if self._active_records >= self.segment_max_records:
+                self._open_next_segment()
+
+    # ---- 読み出し（リプレイ） ----
+    def _read_segment(self, path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # 書き込み途中でクラッシュした行は捨てる
+                    print(f"[LOG] 壊れた行をスキップ: {path}")
+                    continue
+                if "u" in rec:
+                    yield rec["d"], rec["t"], rec["h"], rec["u"]
+                else:
+                    yield rec["d"], rec["t"], rec["h"]
+
+    def replay(self, holds=False):
+        # 起動時の復元用：スナップショット → 未圧縮セグメントの順にサンプルを返す
+        # holds=True なら保持区間のレコードも返す
+        # （読み終わるまで圧縮でセグメントが消されないようロックを持つ）
+        with self._compact_lock:
+            snapshot = self._load_snapshot()
+            segments = [i for i in self._segments() if i > snapshot["last_segment"]]
+            for device_id, cols in snapshot["devices"].items():
+                for ts, hb in zip(cols["t"], cols["h"]):
+                    yield device_id, ts, hb
+                if holds:
+                    for ts, until, hb in cols.get("holds", []):
+                        yield device_id, ts, hb, until
+            for index in segments:
+                for rec in self._read_segment(self._path(_segment_name(index))):
+                    if holds or len(rec) == 3:
+                        yield rec
+
+    def replay_all(self, holds=False):
+        # 生データ全部（アーカイブ + 未圧縮のセグメント）を書いた順に返す
+        with self._compact_lock:
+            for _, path in self._all_segments():
+                for rec in self._read_segment(path):
+                    if holds or len(rec) == 3:
+                        yield rec
+
+    def read_all(self):
+        data = {}
+        for device_id, ts, hb in self.replay_all():
+            data.setdefault(device_id, []).append((ts, hb))
+        return data
+
+    def session(self, devices=None, from_ts=None, to_ts=None):
+        # CSV 出力用の読み出し（端末ごと・時刻順に少しずつ読む。全体をメモリに載せない）
+        return LogSession(self, devices, from_ts, to_ts)
+
+    def _session_segments(self):
+        # [(ファイル名, {device_id: [最初の時刻, 最後の時刻]}), ...]（番号順）
+        # アーカイブは索引から、未圧縮のセグメントは1回読んで範囲を調べる
+        # （調べている間にセグメントが移されないよう圧縮と排他にする）
+        with self._compact_lock:
+            index = self._load_snapshot()["archive"]
+            result = []
+            for i, path in self._all_segments():
+                name = _segment_name(i)
+                ranges = index.get(name)
+                if ranges is None:
+                    ranges = {}
+                    for rec in self._read_segment(path):
+                        _merge_range(ranges, rec[0], rec[1], rec[3] if len(rec) > 3 else rec[1])
+                result.append((name, ranges))
+            return result
+
+    def _read_device(self, name, device_id):
+        # セグメント1個から device_id の行だけを読む（他の端末の行は JSON にしない）
+        # 読んでいる間に圧縮でアーカイブへ移っても、もう片方の場所から開く
+        prefix = '{"d":' + json.dumps(device_id) + ','
+        for directory in (self.directory, self.archive_dir):
+            path = os.path.join(directory, name)
+            try:
+                f = open(path)
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    if not line.startswith(prefix):
+                        continue
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        print(f"[LOG] 壊れた行をスキップ: {path}")
+                        continue
+                    if "u" in rec:
+                        yield rec["d"], rec["t"], rec["h"], rec["u"]
+                    else:
+                        yield rec["d"], rec["t"], rec["h"]
+            return
+
+    # ---- 圧縮 ----
+    def compact(self):
+        # 閉じたセグメントをスナップショットへ畳み込み、ファイルはアーカイブへ移す
+        # スナップショットは直近 HOT_WINDOW_MS 分 + 集計だけなので書き直す量は一定
+        # アーカイブはファイルを移すだけ（中身は書き換えない）
+        with self._compact_lock:
+            snapshot = self._load_snapshot()
+            with self._lock:
+                closed = [
+                    i for i in self._segments()
+                    if i > snapshot["last_segment"] and (self._active == 0 or i < self._active)
+                ]
+            # 前回スナップショットを書いた後、移す前に落ちたセグメント
+            leftover = [i for i in self._segments() if i <= snapshot["last_segment"]]
+            if len(closed) < COMPACT_THRESHOLD:
+                self._move_to_archive(leftover)
+                return 0
+
+            devices = snapshot["devices"]
+            for index in closed:
+                ranges = {}
+                for rec in self._read_segment(self._path(_segment_name(index))):
+                    cols = devices.setdefault(rec[0], {"t": [], "h": []})
+                    if len(rec) > 3:
+                        cols.setdefault("holds", []).append([rec[1], rec[3], rec[2]])
+                        _merge_range(ranges, rec[0], rec[1], rec[3])
+                    else:
+                        cols["t"].append(rec[1])
+                        cols["h"].append(rec[2])
+                        _merge_range(ranges, rec[0], rec[1], rec[1])
+                snapshot["archive"][_segment_name(index)] = ranges
+            snapshot["last_segment"] = closed[-1]
+            self._trim(snapshot)
+            pruned = self._prune(snapshot) if LOG_RETENTION_MS else []
+
+            self._save_snapshot(snapshot)
+            self._move_to_archive(leftover + closed)
+            # 索引に無いアーカイブ（保持期間切れ、前回消す前に落ちた分も）を消す
+            for index in self._archived():
+                if _segment_name(index) not in snapshot["archive"]:
+                    os.remove(os.path.join(self.archive_dir, _segment_name(index)))
+
+        print(f"[LOG] セグメント {len(closed)} 個をスナップショットへ圧縮しました（保持期間切れ {len(pruned)} 個）")
+        return len(closed)
+
+    def _move_to_archive(self, indexes):
+        for index in indexes:
+            name = _segment_name(index)
+            os.replace(self._path(name), os.path.join(self.archive_dir, name))
+
+    def _trim(self, snapshot):
+        # HOT_WINDOW_MS より古い生サンプルは集計へ畳み込んでからスナップショットから外す
+        # （生データはアーカイブに残っている）
+        rollups = snapshot["rollups"]
+        for device_id, cols in snapshot["devices"].items():
+            if not cols["t"]:
+                continue
+            cutoff = max(cols["t"]) - HOT_WINDOW_MS
+            old = [(ts, hb) for ts, hb in zip(cols["t"], cols["h"]) if ts < cutoff]
+            if not old:
+                continue
+            _fold(rollups.setdefault(device_id, {}), old)
+            kept = [(ts, hb) for ts, hb in zip(cols["t"], cols["h"]) if ts >= cutoff]
+            cols["t"] = [ts for ts, _ in kept]
+            cols["h"] = [hb for _, hb in kept]
+            if cols.get("holds"):
+                # 最後の保持区間は残す（同じ区間を二重に記録しないための目印）
+                last = max(cols["holds"], key=lambda h: h[1])
+                cols["holds"] = [h for h in cols["holds"] if h[1] >= cutoff] or [last]
+
+    def _prune(self, snapshot):
+        # 保持期間（LOG_RETENTION_MS）より古いアーカイブを索引から外す
+        # 中身は DB へ取り込む時のために集計だけ残す
+        ends = [r[1] for ranges in snapshot["archive"].values() for r in ranges.values()]
+        if not ends:
+            return []
+        cutoff = max(ends) - LOG_RETENTION_MS
+        pruned = []
+        for name, ranges in sorted(snapshot["archive"].items()):
+            if any(r[1] >= cutoff for r in ranges.values()):
+                continue
+            path = os.path.join(self.archive_dir, name)
+            if not os.path.exists(path):
+                path = self._path(name)
+            rows = {}
+            for rec in self._read_segment(path):
+                if len(rec) == 3:
+                    rows.setdefault(rec[0], []).append((rec[1], rec[2]))
+            for device_id, device_rows in rows.items():
+                _fold(snapshot["pruned_rollups"].setdefault(device_id, {}), device_rows)
+            del snapshot["archive"][name]
+            pruned.append(name)
+        return pruned
+
+    def rollups(self):
+        # スナップショットより古い分の集計 {device_id: {bucket_ms: [row, ...]}}（ストアの復元用）
+        return self._rollups("rollups")
+
+    def pruned_rollups(self):
+        # アーカイブから消した分の集計（replay_all() と合わせて DB へ取り込む用）
+        return self._rollups("pruned_rollups")
+
+    def _rollups(self, key):
+        snapshot = self._load_snapshot()
+        return {
+            device_id: {int(bucket_ms): rows for bucket_ms, rows in tiers.items()}
+            for device_id, tiers in snapshot.get(key, {}).items()
+        }
+
+    def clear(self):
+        with self._compact_lock, self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+            for directory in (self.directory, self.archive_dir):
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    if os.path.isfile(path):
+                        os.remove(path)
+            self._active = 0
+            self._active_records = 0
+
+
+# ----------------------------------------
+# CSV 出力用の読み出し（SampleLog.session() が返す）
+#   devices() の端末ごとに samples() / holds() を時刻順のジェネレーターで返す
+#   セグメントを番号順に読み、「この先のセグメントの最初の時刻」より古い分から順に出すので
+#   メモリに載るのは時刻が重なっているセグメントの分だけ
+# ----------------------------------------
+class LogSession:
+    def __init__(self, log, devices=None, from_ts=None, to_ts=None):
+        self.log = log
+        self.only = set(devices) if devices is not None else None
+        self.lo = float("-inf") if from_ts is None else from_ts
+        self.hi = float("inf") if to_ts is None else to_ts
+        self.segments = log._session_segments()
+
+    def _overlaps(self, r):
+        return r[1] >= self.lo and r[0] < self.hi
+
+    def devices(self):
+        found = set()
+        for _, ranges in self.segments:
+            for device_id, r in ranges.items():
+                if self._overlaps(r) and (self.only is None or device_id in self.only):
+                    found.add(device_id)
+        return sorted(found)
+
+    def samples(self, device_id):
+        # (timestamp, heartbeat) を時刻順に
+        return self._iter(device_id, holds=False)
+
+    def holds(self, device_id):
+        # (from, until, heartbeat) を開始時刻順に
+        return self._iter(device_id, holds=True)
+
+    def _iter(self, device_id, holds):
+        segments = [
+            (name, ranges[device_id]) for name, ranges in self.segments
+            if device_id in ranges and self._overlaps(ranges[device_id])
+        ]
+        # 後ろのセグメントの最初の時刻の最小値（これより古い分はもう出してよい）
+        watermarks = [float("inf")] * (len(segments) + 1)
+        for k in range(len(segments) - 1, -1, -1):
+            watermarks[k] = min(watermarks[k + 1], segments[k][1][0])
+
+        heap = []
+        for k, (name, _) in enumerate(segments):
+            for rec in self.log._read_device(name, device_id):
+                if holds and len(rec) > 3:
+                    if rec[3] > self.lo and rec[1] < self.hi:
+                        heapq.heappush(heap, (rec[1], rec[3], rec[2]))
+                elif not holds and len(rec) == 3:
+                    if self.lo <= rec[1] < self.hi:
+                        heapq.heappush(heap, (rec[1], rec[2]))
+            while heap and heap[0][0] < watermarks[k + 1]:
+                yield heapq.heappop(heap)
+        while heap:
+            yield heapq.heappop(heap)
+
+
+def compact_thread(log):
+    while True:
+        time.sleep(COMPACT_INTERVAL)
+        try:
+            log.compact()
+        except Exception as e:
+            print("[ERROR] サンプルログ圧縮失敗:", e)
+
+
+sample_log = SampleLog()
@@ -0,0 +1,88 @@
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# ----------------------------------------
+# 心拍サンプルの表現
+#   ストアの中は列ごとの array（timestamp: int64 / heartbeat: float32 で1件12バイト）
+#   JSON 用の dict は API で返す直前にだけ作る
+# ----------------------------------------
+def bpm_value(heartbeat):
+    # float32 で持っている値を元の見た目に戻す（72.0 → 72、72.30000305 → 72.3）
+    if heartbeat != heartbeat:
+        return None
+    heartbeat = round(float(heartbeat), 1)
+    return int(heartbeat) if heartbeat.is_integer() else heartbeat
+
+def parse_heartbeat(value):
+    # 受信した心拍を数値にそろえる（"72" → 72、72.5 → 72.5）
+    # ストアの float32 の array に入らない値（文字列・bool・NaN・無限大）は None
+    if isinstance(value, bool):
+        return None
+    try:
+        heartbeat = float(value)
+    except (TypeError, ValueError):
+        return None
+    if heartbeat != heartbeat or heartbeat in (float("inf"), float("-inf")):
+        return None
+    return int(heartbeat) if heartbeat.is_integer() else heartbeat
+
+
+class Sample:
+    # 1件だけ扱う経路（最新値など）用
+    __slots__ = ("timestamp", "heartbeat")
+
+    def __init__(self, timestamp, heartbeat):
+        self.timestamp = timestamp
+        self.heartbeat = heartbeat
+
+    def as_dict(self):
+        return {"timestamp": self.timestamp, "heartbeat": bpm_value(self.heartbeat)}
+
+
+class Columns:
+    # 1台分の系列（timestamps と heartbeats が同じ長さの array）
+    __slots__ = ("timestamps", "heartbeats")
+
+    def __init__(self, timestamps=None, heartbeats=None):
+        self.timestamps = timestamps if timestamps is not None else array('q')
+        self.heartbeats = heartbeats if heartbeats is not None else array('f')
+
+    @classmethod
+    def from_rows(cls, rows):
+        # [(timestamp, heartbeat), ...]（DB の結果など）から作る
+        columns = cls()
+        for ts, hb in rows:
+            columns.timestamps.append(ts)
+            columns.heartbeats.append(hb)
+        return columns
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        return zip(self.timestamps, self.heartbeats)
+
+    def columns(self):
+        # 列のままの形 {"t": [...], "bpm": [...]}（点ごとの dict より書き出し・読み込みが軽い）
+        # bpm は小数1桁に丸めた float（72 も 72.0 になる）
+        if np is not None:
+            bpm = np.round(np.frombuffer(self.heartbeats, dtype=np.float32).astype(np.float64), 1).tolist()
+        else:
+            bpm = [round(hb, 1) for hb in self.heartbeats.tolist()]
+        return {"t": self.timestamps.tolist(), "bpm": bpm}
+
+    def render(self, fmt):
+        # ?format=columns なら列の形、それ以外は従来の点ごとの dict
+        return self.columns() if fmt == "columns" else self.records()
+
+    def records(self):
+        return [{"timestamp": ts, "heartbeat": bpm_value(hb)} for ts, hb in self]
+
+    def history_records(self):
+        # heart_history.json の形
+        return [{"time": ts, "bpm": bpm_value(hb)} for ts, hb in self]
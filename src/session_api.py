@@ -0,0 +1,180 @@
+from flask import Blueprint, request, jsonify
+import os
+
+from csv_export import EXPORT_NAME, file_key, read_rows
+from storage import load_json_file, save_json_file, file_lock
+
+session_api = Blueprint('session_api', __name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# /export_csv の保存先（CSV の保管庫）
+DATA_DIR = os.path.join(BASE_DIR, 'data')
+CATALOG_FILE = os.path.join(DATA_DIR, 'catalog.json')
+
+
+# ----------------------------------------
+# 1セッション分の集計（端末ごとの件数・時間の範囲・min / mean / max）
+#   CSV を書きながら / 読みながら1行ずつ足していく
+# ----------------------------------------
+class SessionStats:
+    def __init__(self):
+        self.devices = {}
+
+    def add(self, device_id, timestamp, heartbeat):
+        stats = self.devices.get(device_id)
+        if stats is None:
+            self.devices[device_id] = [1, timestamp, timestamp, heartbeat, heartbeat, heartbeat]
+            return
+        stats[0] += 1
+        stats[1] = min(stats[1], timestamp)
+        stats[2] = max(stats[2], timestamp)
+        stats[3] = min(stats[3], heartbeat)
+        stats[4] = max(stats[4], heartbeat)
+        stats[5] += heartbeat
+
+    def summary(self):
+        devices = {
+            d: {
+                "rows": rows,
+                "start": start,
+                "end": end,
+                "min": low,
+                "mean": round(total / rows, 1),
+                "max": high
+            }
+            for d, (rows, start, end, low, high, total) in sorted(self.devices.items())
+        }
+        if not devices:
+            return {"rows": 0, "start": None, "end": None, "duration_ms": 0, "devices": {}}
+        start = min(s["start"] for s in devices.values())
+        end = max(s["end"] for s in devices.values())
+        return {
+            "rows": sum(s["rows"] for s in devices.values()),
+            "start": start,
+            "end": end,
+            "duration_ms": end - start,
+            "devices": devices
+        }
+
+
+def _scan_file(path):
+    # 目録に無い CSV（手で置いたもの・以前の出力）は1回だけ読んで集計する
+    stats = SessionStats()
+    for device_id, timestamp, heartbeat in read_rows(path):
+        stats.add(device_id, timestamp, heartbeat)
+    return stats
+
+def _exported_at(stamp):
+    # 以前の出力は秒、今の出力は ms でファイル名に入っている
+    return stamp if stamp >= 10 ** 11 else stamp * 1000
+
+def _entry(name, st, stats, baselines=None):
+    match = EXPORT_NAME.match(name)
+    entry = {
+        "file": name,
+        "exported_at": _exported_at(int(match.group(1))),
+        "compressed": bool(match.group(2)),
+        "key": file_key(st)
+    }
+    entry.update(stats.summary())
+    # 書き出した時点の baseline（watchN は夜ごとに別の人なので、そのセッションの値を残す）
+    entry["baselines"] = {
+        d: v for d, v in (baselines or {}).items()
+        if d in entry["devices"] and isinstance(v, (int, float)) and not isinstance(v, bool)
+    }
+    return entry
+
+
+# ----------------------------------------
+# data/ の CSV の目録（data/catalog.json）
+#   書き出し時に record() で1件追加、知らないファイルは refresh() で差分だけ読む
+#   一覧・絞り込みは目録だけで答える（CSV は開かない）
+# ----------------------------------------
+def record(path, stats, baselines=None):
+    # /export_csv が書き終えた時に呼ぶ（書きながら集計した stats をそのまま使う）
+    # baselines はその時点の baseline.json（分析でそのセッションの基準にする）
+    name = os.path.basename(path)
+    if not EXPORT_NAME.match(name):
+        return
+    with file_lock(CATALOG_FILE):
+        catalog = load_json_file(CATALOG_FILE)
+        catalog[name] = _entry(name, os.stat(path), stats, baselines)
+        save_json_file(CATALOG_FILE, catalog, indent=None)
+
+def refresh():
+    # 増えた・変わったファイルだけ読み、消えたファイルは目録から外す
+    if not os.path.isdir(DATA_DIR):
+        return {}
+    with file_lock(CATALOG_FILE):
+        catalog = load_json_file(CATALOG_FILE)
+        changed = False
+        names = set()
+        for name in os.listdir(DATA_DIR):
+            if not EXPORT_NAME.match(name):
+                continue
+            names.add(name)
+            path = os.path.join(DATA_DIR, name)
+            st = os.stat(path)
+            entry = catalog.get(name)
+            if entry is not None and entry["key"] == file_key(st):
+                continue
+            try:
+                # 読み直しても書き出し時の baseline は引き継ぐ
+                baselines = entry.get("baselines") if entry is not None else None
+                catalog[name] = _entry(name, st, _scan_file(path), baselines)
+            except (OSError, EOFError) as e:
+                print(f"[CATALOG] {name} を読めませんでした:", e)
+                continue
+            print(f"[CATALOG] {name} を目録に追加しました")
+            changed = True
+        for name in set(catalog) - names:
+            del catalog[name]
+            changed = True
+        if changed:
+            save_json_file(CATALOG_FILE, catalog, indent=None)
+        return catalog
+
+
+# ----------------------------------------
+# 📚 GET /sessions（保存済みセッションの一覧）
+#   ?device=watch2       その端末を含むセッションだけ
+#   ?from= / ?to=        時刻(ms)の範囲に掛かるセッションだけ
+#   ?min_duration_ms=    この長さ以上のセッションだけ
+# ----------------------------------------
+@session_api.route('/sessions', methods=['GET'])
+def list_sessions():
+    try:
+        device = request.args.get("device")
+        from_ts = request.args.get("from", type=int)
+        to_ts = request.args.get("to", type=int)
+        min_duration = request.args.get("min_duration_ms", 0, type=int)
+
+        sessions = []
+        for entry in refresh().values():
+            if device and device not in entry["devices"]:
+                continue
+            if entry["start"] is None:
+                if device or from_ts is not None or to_ts is not None:
+                    continue
+            else:
+                if from_ts is not None and entry["end"] < from_ts:
+                    continue
+                if to_ts is not None and entry["start"] >= to_ts:
+                    continue
+            if entry["duration_ms"] < min_duration:
+                continue
+            sessions.append({k: v for k, v in entry.items() if k != "key"})
+
+        sessions.sort(key=lambda e: e["exported_at"], reverse=True)
+        return jsonify({"count": len(sessions), "sessions": sessions})
+
+    except Exception as e:
+        print("GET /sessions error:", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@session_api.route('/sessions/<name>', methods=['GET'])
+def get_session(name):
+    entry = refresh().get(name)
+    if entry is None:
+        return jsonify({"status": "error", "message": f"{name} は見つかりません"}), 404
+    return jsonify({k: v for k, v in entry.items() if k != "key"})
@@ -0,0 +1,229 @@
+import json
+import os
+from bisect import bisect_left
+import struct
+import sys
+import zlib
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from csv_export import read_rows
+from samples import Columns
+
+MAGIC = b"HRA1"
+# 1ブロックあたりのサンプル数（時間範囲で読む時はブロック単位で飛ばす）
+BLOCK_ROWS = 4096
+# BPM は 0.1 刻みの整数にして持つ
+BPM_SCALE = 10
+
+
+# ----------------------------------------
+# 終わったセッションの圧縮アーカイブ（CSV の隣に置く .hra）
+#   MAGIC / ヘッダー長(uint32) / ヘッダー(JSON) / ブロック...
+#   ヘッダー: {"devices": {device_id: [[offset, length, count, start, end], ...]}}
+#   ブロック（zlib 圧縮）: 件数 / timestamp の差分 varint / BPM の (値, 連続数) varint
+#     - timestamp は先頭の値とその後の差分（1Hz ならほぼ 1000 の繰り返し）
+#     - BPM は同じ値の連続をまとめる（保持区間の補完行は1組になる）
+# ----------------------------------------
+def archive_path(csv_path):
+    # heart_rate_data_<ts>.csv(.gz) → heart_rate_data_<ts>.hra
+    base = csv_path[:-3] if csv_path.endswith(".gz") else csv_path
+    return os.path.splitext(base)[0] + ".hra"
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+def _unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+def _put_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _get_varints(data, pos, count):
+    values = []
+    for _ in range(count):
+        n = shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        values.append(n)
+    return values, pos
+
+def _np_varints(data):
+    # varint の列をまとめて NumPy でデコード
+    b = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shift = (np.arange(len(b)) - starts[group]) * 7
+    return np.add.reduceat((b & 0x7F).astype(np.int64) << shift, starts)
+
+
+def _encode_block(timestamps, heartbeats):
+    ts_bytes = bytearray()
+    prev = 0
+    for ts in timestamps:
+        _put_varint(ts_bytes, _zigzag(ts - prev))
+        prev = ts
+
+    bpm_bytes = bytearray()
+    runs = 0
+    current = None
+    for hb in heartbeats:
+        value = int(round(hb * BPM_SCALE))
+        if value == current:
+            runs += 1
+            continue
+        if current is not None:
+            _put_varint(bpm_bytes, _zigzag(current))
+            _put_varint(bpm_bytes, runs)
+        current, runs = value, 1
+    if current is not None:
+        _put_varint(bpm_bytes, _zigzag(current))
+        _put_varint(bpm_bytes, runs)
+
+    head = bytearray()
+    _put_varint(head, len(timestamps))
+    _put_varint(head, len(ts_bytes))
+    return zlib.compress(bytes(head + ts_bytes + bpm_bytes), 6)
+
+def _decode_block(block):
+    data = zlib.decompress(block)
+    (count, ts_len), pos = _get_varints(data, 0, 2)
+    ts_data = data[pos:pos + ts_len]
+    bpm_data = data[pos + ts_len:]
+
+    if np is not None:
+        timestamps = np.cumsum(_unzigzag_np(_np_varints(ts_data)))
+        pairs = _np_varints(bpm_data)
+        values = _unzigzag_np(pairs[0::2]).astype(np.float32) / BPM_SCALE
+        heartbeats = np.repeat(values, pairs[1::2])
+        return (
+            array('q', timestamps.astype(np.int64).tobytes()),
+            array('f', heartbeats.astype(np.float32).tobytes())
+        )
+
+    deltas, _ = _get_varints(ts_data, 0, count)
+    timestamps = array('q')
+    ts = 0
+    for delta in deltas:
+        ts += _unzigzag(delta)
+        timestamps.append(ts)
+    heartbeats = array('f')
+    pos = 0
+    while pos < len(bpm_data):
+        (value, runs), pos = _get_varints(bpm_data, pos, 2)
+        heartbeats.extend([_unzigzag(value) / BPM_SCALE] * runs)
+    return timestamps, heartbeats
+
+def _unzigzag_np(values):
+    return (values >> 1) ^ -(values & 1)
+
+
+# ----------------------------------------
+# 書き込み（CSV を書きながら add() で1行ずつ渡し、最後に write()）
+# ----------------------------------------
+class ArchiveWriter:
+    def __init__(self):
+        self.devices = {}
+
+    def add(self, device_id, timestamp, heartbeat):
+        cols = self.devices.get(device_id)
+        if cols is None:
+            cols = self.devices[device_id] = (array('q'), array('f'))
+        cols[0].append(timestamp)
+        cols[1].append(heartbeat)
+
+    def write(self, path):
+        index = {}
+        blocks = []
+        offset = 0
+        for device_id, (timestamps, heartbeats) in sorted(self.devices.items()):
+            entries = index[device_id] = []
+            # 時刻順にそろえてからブロックに分ける
+            order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+            ts = [timestamps[i] for i in order]
+            hb = [heartbeats[i] for i in order]
+            for lo in range(0, len(ts), BLOCK_ROWS):
+                block = _encode_block(ts[lo:lo + BLOCK_ROWS], hb[lo:lo + BLOCK_ROWS])
+                count = min(BLOCK_ROWS, len(ts) - lo)
+                entries.append([offset, len(block), count, ts[lo], ts[lo + count - 1]])
+                blocks.append(block)
+                offset += len(block)
+
+        header = json.dumps({"devices": index}, separators=(",", ":")).encode("utf-8")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            for block in blocks:
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        print(f"[ARCHIVE] {path} に保存しました（{offset + len(header) + 8} バイト）")
+
+
+# ----------------------------------------
+# 読み出し（ヘッダーのブロック索引で必要なブロックだけ読む）
+# ----------------------------------------
+def read_index(f):
+    if f.read(4) != MAGIC:
+        raise ValueError("アーカイブの形式が違います")
+    (length,) = struct.unpack("<I", f.read(4))
+    header = json.loads(f.read(length))
+    return header["devices"], 8 + length
+
+def read_archive(path, devices=None, from_ts=None, to_ts=None):
+    # 戻り値: {device_id: Columns}（時刻順）
+    # [from_ts, to_ts) に掛からないブロックは読まない
+    result = {}
+    with open(path, "rb") as f:
+        index, base = read_index(f)
+        for device_id, entries in index.items():
+            if devices is not None and device_id not in devices:
+                continue
+            columns = Columns()
+            for offset, length, _, start, end in entries:
+                if from_ts is not None and end < from_ts:
+                    continue
+                if to_ts is not None and start >= to_ts:
+                    break
+                f.seek(base + offset)
+                ts, hb = _decode_block(f.read(length))
+                columns.timestamps.extend(ts)
+                columns.heartbeats.extend(hb)
+            if from_ts is not None or to_ts is not None:
+                # 端のブロックの範囲外の分を切り落とす
+                lo = 0 if from_ts is None else bisect_left(columns.timestamps, from_ts)
+                hi = len(columns) if to_ts is None else bisect_left(columns.timestamps, to_ts)
+                columns = Columns(columns.timestamps[lo:hi], columns.heartbeats[lo:hi])
+            result[device_id] = columns
+    return result
+
+def convert(csv_path):
+    # 既存の CSV から .hra を作る
+    writer = ArchiveWriter()
+    for device_id, timestamp, heartbeat in read_rows(csv_path):
+        writer.add(device_id, timestamp, heartbeat)
+    path = archive_path(csv_path)
+    writer.write(path)
+    return path
+
+
+if __name__ == "__main__":
+    # python session_archive.py data/heart_rate_data_*.csv
+    for name in sys.argv[1:]:
+        convert(name)
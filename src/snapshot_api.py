@@ -0,0 +1,64 @@
+from flask import Blueprint, request, jsonify
+import os
+
+from event_bus import bus
+from heart_api import latest_all
+from storage import load_json_file
+from game_state import game_state
+from http_cache import conditional_json
+
+snapshot_api = Blueprint('snapshot_api', __name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSIGNED_FILE = os.path.join(BASE_DIR, 'assigned_ids.json')
+BASELINE_FILE = os.path.join(BASE_DIR, 'baseline.json')
+
+
+# ----------------------------------------
+# 状態をまとめた1つのビュー
+#   version はイベントバスの最新 id（変更のたびに増える）
+# ----------------------------------------
+def build_snapshot():
+    # 組み立て中に更新が入ったら組み立て直す（フィールド間で食い違わないように）
+    for _ in range(3):
+        version = bus.last_id
+        state = game_state.snapshot()
+        assigned = load_json_file(ASSIGNED_FILE)
+        snapshot = {
+            "version": version,
+            "running": state["running"],
+            "game_over": state["game_over"],
+            "baseline_mode": state["baseline_mode"],
+            "current_turn": state["current_turn"],
+            "clients": {"count": len(assigned), "ids": assigned},
+            "baselines": load_json_file(BASELINE_FILE),
+            "mode": state["mode"],
+            "latest": latest_all()
+        }
+        if bus.last_id == version:
+            break
+    return snapshot
+
+def current_state():
+    # motor_controller 向けの小さい形
+    snapshot = build_snapshot()
+    return {
+        "running": snapshot["running"],
+        "game_over": snapshot["game_over"],
+        "baseline_mode": snapshot["baseline_mode"],
+        "current_turn": snapshot["current_turn"],
+        "ids": sorted(set(snapshot["clients"]["ids"].values())),
+        "baselines": snapshot["baselines"],
+        "mode": snapshot["mode"],
+        "heart": {d: r["heartbeat"] for d, r in snapshot["latest"].items()}
+    }
+
+# ----------------------------------------
+# 📸 GET /snapshot（?since_version= と同じなら中身を省略、If-None-Match なら 304）
+# ----------------------------------------
+@snapshot_api.route('/snapshot', methods=['GET'])
+def get_snapshot():
+    since = request.args.get("since_version", type=int)
+    if since is not None and since == bus.last_id:
+        return jsonify({"version": since, "changed": False})
+    return conditional_json(build_snapshot)
@@ -0,0 +1,289 @@
+import time
+
+import heart_db
+from resampled_view import resample, TICK_MS
+from rollups import TIERS, LOG_RETENTION_MS
+from samples import Sample, Columns
+
+# 古い集計・生サンプルを消す間隔（秒）
+PRUNE_INTERVAL = 60
+
+
+# ----------------------------------------
+# SQLite 版の心拍ストア（HeartStore と同じメソッド）
+#   samples / holds テーブルを (device_id, timestamp) の索引で引く
+#   全ワーカーが同じ DB を見るので、どのプロセスに POST しても同じ結果になる
+# ----------------------------------------
+class SqliteHeartStore:
+    def __init__(self, history_length):
+        self.history_length = history_length
+
+    def _insert(self, conn, device_id, timestamp, heartbeat):
+        conn.execute("INSERT OR IGNORE INTO devices (device_id) VALUES (?)", (device_id,))
+        conn.execute(
+            "INSERT INTO samples (device_id, timestamp, heartbeat) VALUES (?, ?, ?)",
+            (device_id, timestamp, heartbeat)
+        )
+        # 集計は該当バケットの1行だけを更新
+        for bucket_ms, _ in TIERS:
+            self._merge_rollup(conn, device_id, bucket_ms, timestamp // bucket_ms, 1, heartbeat, heartbeat, heartbeat)
+
+    def _merge_rollup(self, conn, device_id, bucket_ms, bucket, count, total, low, high):
+        conn.execute(
+            "INSERT INTO rollups (device_id, bucket_ms, bucket, count, total, low, high) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (device_id, bucket_ms, bucket) DO UPDATE SET "
+            "count = count + excluded.count, total = total + excluded.total, "
+            "low = MIN(low, excluded.low), high = MAX(high, excluded.high)",
+            (device_id, bucket_ms, bucket, count, total, low, high)
+        )
+
+    def _latest_row(self, conn, device_id, before=None):
+        if before is None:
+            return conn.execute(
+                "SELECT timestamp, heartbeat FROM samples WHERE device_id = ? "
+                "ORDER BY timestamp DESC LIMIT 1", (device_id,)
+            ).fetchone()
+        return conn.execute(
+            "SELECT timestamp, heartbeat FROM samples WHERE device_id = ? AND timestamp < ? "
+            "ORDER BY timestamp DESC LIMIT 1", (device_id, before)
+        ).fetchone()
+
+    def _mark_hold(self, conn, device_id, until_ts):
+        # 直前の実測値から until_ts までを保持区間として記録（HeartStore._mark_hold と同じ）
+        last = self._latest_row(conn, device_id)
+        if last is None:
+            return
+        held = conn.execute(
+            "SELECT MAX(until) FROM holds WHERE device_id = ?", (device_id,)
+        ).fetchone()[0] or 0
+        start = max(last[0], held)
+        if until_ts - start > TICK_MS:
+            conn.execute(
+                "INSERT INTO holds (device_id, start, until, heartbeat) VALUES (?, ?, ?, ?)",
+                (device_id, start, until_ts, last[1])
+            )
+
+    def append(self, device_id, timestamp, heartbeat, hold=False):
+        with heart_db.transaction() as conn:
+            if hold:
+                self._mark_hold(conn, device_id, timestamp)
+            self._insert(conn, device_id, timestamp, heartbeat)
+
+    def extend(self, device_id, samples, hold=False):
+        samples = sorted(samples, key=lambda s: s[0])
+        if not samples:
+            return []
+        with heart_db.transaction() as conn:
+            prev = self._latest_row(conn, device_id)
+            for timestamp, heartbeat in samples:
+                if hold:
+                    self._mark_hold(conn, device_id, timestamp)
+                self._insert(conn, device_id, timestamp, heartbeat)
+        if prev is None:
+            return samples
+        return [s for s in samples if s[0] > prev[0]]
+
+    def load(self, samples, rollups=None):
+        # サンプルログからの移行用（DB が空の時だけ呼ぶ）
+        with heart_db.transaction() as conn:
+            for device_id, tiers in (rollups or {}).items():
+                for bucket_ms, rows in tiers.items():
+                    for row in rows:
+                        self._merge_rollup(conn, device_id, bucket_ms, *row)
+            for rec in samples:
+                if len(rec) > 3:
+                    conn.execute(
+                        "INSERT INTO holds (device_id, start, until, heartbeat) VALUES (?, ?, ?, ?)",
+                        (rec[0], rec[1], rec[3], rec[2])
+                    )
+                else:
+                    self._insert(conn, *rec)
+
+    def is_empty(self):
+        conn = heart_db.connect()
+        return conn.execute("SELECT 1 FROM samples LIMIT 1").fetchone() is None
+
+    def close_holds(self, until_ts):
+        with heart_db.transaction() as conn:
+            for device_id in self.devices():
+                self._mark_hold(conn, device_id, until_ts)
+
+    def clear(self, on_cleared=None):
+        with heart_db.transaction() as conn:
+            conn.execute("DELETE FROM samples")
+            conn.execute("DELETE FROM holds")
+            conn.execute("DELETE FROM rollups")
+            conn.execute("DELETE FROM devices")
+            if on_cleared:
+                on_cleared()
+
+    def set_sink(self, sink):
+        # DB 自体が永続化先なので書き出しキューは使わない
+        pass
+
+    def devices(self):
+        conn = heart_db.connect()
+        return [row[0] for row in conn.execute("SELECT device_id FROM devices ORDER BY device_id")]
+
+    def latest(self, device_id):
+        row = self._latest_row(heart_db.connect(), device_id)
+        if row is None:
+            return None
+        return Sample(*row)
+
+    def latest_all(self):
+        conn = heart_db.connect()
+        result = {}
+        for device_id in self.devices():
+            row = self._latest_row(conn, device_id)
+            if row is not None:
+                result[device_id] = Sample(*row)
+        return result
+
+    def _range(self, conn, device_id, from_ts, to_ts=None):
+        if to_ts is None:
+            return conn.execute(
+                "SELECT timestamp, heartbeat FROM samples WHERE device_id = ? AND timestamp >= ? "
+                "ORDER BY timestamp", (device_id, from_ts)
+            ).fetchall()
+        return conn.execute(
+            "SELECT timestamp, heartbeat FROM samples WHERE device_id = ? AND timestamp >= ? AND timestamp < ? "
+            "ORDER BY timestamp", (device_id, from_ts, to_ts)
+        ).fetchall()
+
+    def window(self, device_id, from_ts, to_ts=None):
+        return Columns.from_rows(self._range(heart_db.connect(), device_id, from_ts, to_ts))
+
+    def window_all(self, from_ts, to_ts=None):
+        conn = heart_db.connect()
+        return {d: Columns.from_rows(self._range(conn, d, from_ts, to_ts)) for d in self.devices()}
+
+    def resampled_all(self, from_ts, now_ms, fill=True):
+        # 読み出し時に 1Hz へリサンプル（区間の直前の1件から保持値を引き継ぐ）
+        # 保持は MAX_HOLD_SEC まで、fill=False なら最後の実測値の秒までで止める（HeartStore と同じ）
+        now_sec = now_ms // TICK_MS
+        from_sec = from_ts // TICK_MS
+        conn = heart_db.connect()
+        result = {}
+        for device_id in self.devices():
+            before = self._latest_row(conn, device_id, before=from_sec * TICK_MS)
+            rows = self._range(conn, device_id, from_sec * TICK_MS)
+            samples = ([tuple(before)] if before else []) + [tuple(r) for r in rows]
+            if not samples:
+                continue
+            to_sec = now_sec if fill else min(now_sec, samples[-1][0] // TICK_MS)
+            values = resample(samples, from_sec, to_sec)
+            columns = Columns.from_rows(
+                ((from_sec + n) * TICK_MS, v) for n, v in enumerate(values) if v is not None
+            )
+            if len(columns):
+                result[device_id] = columns
+        return result
+
+    def rollup_all(self, bucket_ms, from_ts, to_ts=None):
+        conn = heart_db.connect()
+        hi = None if to_ts is None else -(-to_ts // bucket_ms)
+        result = {}
+        for device_id in self.devices():
+            rows = conn.execute(
+                "SELECT bucket, count, total, low, high FROM rollups "
+                "WHERE device_id = ? AND bucket_ms = ? AND bucket >= ? AND (? IS NULL OR bucket < ?) "
+                "ORDER BY bucket", (device_id, bucket_ms, from_ts // bucket_ms, hi, hi)
+            ).fetchall()
+            if rows:
+                result[device_id] = rows
+        return result
+
+    def prune(self):
+        # 段ごとの保持数を超えた集計と、保持期間より古い生サンプルを消す
+        # （生サンプルは書き込み時に集計済みなので消しても集計は残る）
+        with heart_db.transaction() as conn:
+            for bucket_ms, capacity in TIERS:
+                conn.execute(
+                    "DELETE FROM rollups WHERE bucket_ms = ? AND bucket <= "
+                    "(SELECT MAX(bucket) FROM rollups WHERE bucket_ms = ?) - ?",
+                    (bucket_ms, bucket_ms, capacity)
+                )
+            if LOG_RETENTION_MS:
+                conn.execute(
+                    "DELETE FROM samples WHERE timestamp < (SELECT MAX(timestamp) FROM samples) - ?",
+                    (LOG_RETENTION_MS,)
+                )
+                conn.execute(
+                    "DELETE FROM holds WHERE until < (SELECT MAX(timestamp) FROM samples) - ?",
+                    (LOG_RETENTION_MS,)
+                )
+
+    def history(self):
+        conn = heart_db.connect()
+        result = {}
+        for device_id in self.devices():
+            rows = conn.execute(
+                "SELECT timestamp, heartbeat FROM samples WHERE device_id = ? "
+                "ORDER BY timestamp DESC LIMIT ?", (device_id, self.history_length)
+            ).fetchall()
+            result[device_id] = Columns.from_rows(reversed(rows))
+        return result
+
+    def session(self, devices=None, from_ts=None, to_ts=None):
+        # CSV 出力用（SampleLog.session と同じ形・同じ絞り込み）
+        return DbSession(devices, from_ts, to_ts)
+
+
+# ----------------------------------------
+# CSV 出力用の読み出し（SqliteHeartStore.session() が返す）
+#   端末ごとに ORDER BY timestamp のカーソルを回すだけ（全体をメモリに載せない）
+# ----------------------------------------
+class DbSession:
+    def __init__(self, devices=None, from_ts=None, to_ts=None):
+        self.only = list(devices) if devices is not None else None
+        self.from_ts = from_ts
+        self.to_ts = to_ts
+
+    def _where(self, start_col, end_col):
+        where, args = [], []
+        if self.from_ts is not None:
+            where.append(f"{end_col} >= ?" if start_col == end_col else f"{end_col} > ?")
+            args.append(self.from_ts)
+        if self.to_ts is not None:
+            where.append(f"{start_col} < ?")
+            args.append(self.to_ts)
+        return "".join(f" AND {w}" for w in where), args
+
+    def devices(self):
+        conn = heart_db.connect()
+        sample_where, sample_args = self._where("timestamp", "timestamp")
+        hold_where, hold_args = self._where("start", "until")
+        # 端末ごとに索引で1件あるかだけ見る
+        rows = conn.execute(
+            "SELECT device_id FROM devices d WHERE "
+            f"EXISTS (SELECT 1 FROM samples WHERE device_id = d.device_id{sample_where}) OR "
+            f"EXISTS (SELECT 1 FROM holds WHERE device_id = d.device_id{hold_where}) "
+            "ORDER BY device_id",
+            sample_args + hold_args
+        )
+        return [d for (d,) in rows if self.only is None or d in self.only]
+
+    def samples(self, device_id):
+        where, args = self._where("timestamp", "timestamp")
+        return heart_db.connect().execute(
+            f"SELECT timestamp, heartbeat FROM samples WHERE device_id = ?{where} ORDER BY timestamp",
+            [device_id] + args
+        )
+
+    def holds(self, device_id):
+        where, args = self._where("start", "until")
+        return heart_db.connect().execute(
+            f"SELECT start, until, heartbeat FROM holds WHERE device_id = ?{where} ORDER BY start",
+            [device_id] + args
+        )
+
+
+def prune_thread(store):
+    while True:
+        time.sleep(PRUNE_INTERVAL)
+        try:
+            store.prune()
+        except Exception as e:
+            print("[DB ERROR] 古いデータの削除失敗:", e)
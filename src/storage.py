@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+
+import heart_db
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# ----------------------------------------
+# JSON ファイルの共通読み書き
+#   - ファイルごとのロック（どのモジュールから触っても同じロック）
+#   - 一時ファイルに書いてから os.replace（途中までの内容は誰にも見えない）
+#   - パース結果を mtime で キャッシュ（変わっていなければ読み直さない）
+#   HEART_DB が有効なら中身は DB の documents テーブルに置く
+#   （ロックはワーカー間の flock、キャッシュは version で判定）
+# ----------------------------------------
+_locks = {}
+_locks_lock = threading.Lock()
+_cache = {}
+
+
+def resolve(filename):
+    # 相対パスは実行ディレクトリではなく src/ 基準にそろえる
+    if os.path.isabs(filename):
+        return filename
+    return os.path.join(BASE_DIR, filename)
+
+def file_lock(filename):
+    path = resolve(filename)
+    if heart_db.enabled:
+        return heart_db.process_lock(_document_name(path))
+    with _locks_lock:
+        lock = _locks.get(path)
+        if lock is None:
+            # 読んでから書くまでを囲めるよう再入可能にしておく
+            lock = _locks[path] = threading.RLock()
+        return lock
+
+def _copy(obj):
+    # JSON の値（dict / list / 値）だけなので deepcopy より速い
+    if isinstance(obj, dict):
+        return {k: _copy(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_copy(v) for v in obj]
+    return obj
+
+def _key(st):
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def load_json_file(filename):
+    # 呼び出し側が書き換えてもよいようにコピーを返す
+    path = resolve(filename)
+    if heart_db.enabled:
+        return _load_document(path)
+    with file_lock(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            _cache.pop(path, None)
+            return {}
+
+        cached = _cache.get(path)
+        if cached is not None and cached[0] == _key(st):
+            return _copy(cached[1])
+
+        with open(path) as f:
+            content = f.read().strip()
+        data = json.loads(content) if content else {}
+        _cache[path] = (_key(st), data)
+        return _copy(data)
+
+def save_json_file(filename, data, indent=2):
+    path = resolve(filename)
+    if heart_db.enabled:
+        _save_document(path, data)
+        return
+    with file_lock(path):
+        # 別プロセスと一時ファイル名がぶつからないよう pid を付ける
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        _cache[path] = (_key(os.stat(path)), _copy(data))
+
+def update_json_file(filename, func):
+    # 読み込み → func で書き換え → 保存 を同じロックの中で行う
+    # 戻り値は func の戻り値
+    path = resolve(filename)
+    with file_lock(path):
+        data = load_json_file(path)
+        result = func(data)
+        save_json_file(path, data)
+        return result
+
+
+# ----------------------------------------
+# DB（documents テーブル）版
+# ----------------------------------------
+def _document_name(path):
+    return os.path.relpath(path, BASE_DIR)
+
+def _load_document(path):
+    name = _document_name(path)
+    row = heart_db.connect().execute(
+        "SELECT version, body FROM documents WHERE name = ?", (name,)
+    ).fetchone()
+    if row is None:
+        # まだ DB に無ければ既存のファイルから取り込む（ファイル保存からの移行）
+        data = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                content = f.read().strip()
+            data = json.loads(content) if content else {}
+            if data:
+                _save_document(path, data, only_if_missing=True)
+        return data
+
+    version, body = row
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == version:
+        return _copy(cached[1])
+    data = json.loads(body)
+    _cache[path] = (version, data)
+    return _copy(data)
+
+def _save_document(path, data, only_if_missing=False):
+    name = _document_name(path)
+    body = json.dumps(data, ensure_ascii=False)
+    with heart_db.transaction() as conn:
+        if only_if_missing:
+            conn.execute(
+                "INSERT OR IGNORE INTO documents (name, body, version) VALUES (?, ?, 1)",
+                (name, body)
+            )
+            return
+        conn.execute(
+            "INSERT INTO documents (name, body, version) VALUES (?, ?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET body = excluded.body, version = documents.version + 1",
+            (name, body)
+        )
@@ -0,0 +1,116 @@
+from flask import Blueprint, Response, request
+import json
+
+from event_bus import bus
+from snapshot_api import current_state
+
+stream_api = Blueprint('stream_api', __name__)
+
+# 何も起きない時に接続維持用のコメントを送る間隔（秒）
+KEEPALIVE_SEC = 15
+
+# モーター制御に関係するイベント
+STATE_EVENTS = {"sample", "turn", "status", "baselines", "clients", "control_mode"}
+
+
+def format_sse(event_id, kind, data):
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    return f"id: {event_id}\nevent: {kind}\ndata: {payload}\n\n"
+
+def event_stream(last_id):
+    # ブラウザの自動再接続は2秒後
+    yield "retry: 2000\n\n"
+    while True:
+        events, missed = bus.wait(last_id, KEEPALIVE_SEC)
+        if missed:
+            # 再送できる範囲を超えて取りこぼした → クライアントに全体を取り直させる
+            last_id = events[-1][0] if events else bus.last_id
+            yield format_sse(last_id, "resync", {})
+            continue
+        if not events:
+            yield ": keepalive\n\n"
+            continue
+        for event_id, kind, data in events:
+            yield format_sse(event_id, kind, data)
+        last_id = events[-1][0]
+
+# ----------------------------------------
+# 📡 GET /stream（Server-Sent Events）
+#   sample / turn / status / baselines / clients / control_mode を発生時に送る
+#   再接続時は Last-Event-ID 以降を再送
+# ----------------------------------------
+@stream_api.route('/stream')
+def stream():
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_id = int(last_id)
+    except (TypeError, ValueError):
+        # 初回接続はこれから起きるイベントだけ
+        last_id = bus.last_id
+
+    print(f"[STREAM] 接続: {request.remote_addr} (last_id={last_id})")
+    return Response(
+        event_stream(last_id),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def state_update(kind, data):
+    # イベントを状態の差分（変わったフィールドだけ）に変換
+    if kind == "sample":
+        return {"heart": {data["device_id"]: data["heartbeat"]}}
+    if kind == "turn":
+        return {"current_turn": data["current_turn"]}
+    if kind == "status":
+        return dict(data)
+    if kind == "baselines":
+        return {"baselines": data}
+    if kind == "clients":
+        return {"ids": sorted(set(data["ids"].values()))}
+    if kind == "control_mode":
+        return {"mode": data["mode"]}
+    return None
+
+def format_line(message):
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+def state_stream():
+    # 最初に全体、その後は変化があった時だけ差分を1行ずつ送る（NDJSON）
+    last_id = bus.last_id
+    yield format_line(dict(current_state(), type="state", v=last_id))
+    while True:
+        events, missed = bus.wait(last_id, KEEPALIVE_SEC)
+        if missed or any(kind == "resync" for _, kind, _ in events):
+            last_id = events[-1][0] if events else bus.last_id
+            yield format_line(dict(current_state(), type="state", v=last_id))
+            continue
+        if not events:
+            # 接続維持用の空行
+            yield "\n"
+            continue
+        # まとめて届いたイベントは1つの差分に畳んで送る
+        merged = {}
+        for _, kind, data in events:
+            if kind not in STATE_EVENTS:
+                continue
+            update = state_update(kind, data)
+            heart = update.pop("heart", None)
+            if heart:
+                merged.setdefault("heart", {}).update(heart)
+            merged.update(update)
+        last_id = events[-1][0]
+        if merged:
+            yield format_line(dict(merged, type="update", v=last_id))
+
+# ----------------------------------------
+# 🛰 GET /state_stream（motor_controller 向けの push チャネル）
+# ----------------------------------------
+@stream_api.route('/state_stream')
+def get_state_stream():
+    print(f"[STREAM] 状態購読: {request.remote_addr}")
+    return Response(
+        state_stream(),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,39 +1,20 @@
 from flask import Blueprint, jsonify
-import json
-import os
-import threading
 
+from game_state import game_state
+from storage import load_json_file
+from http_cache import conditional_json
 turn_api = Blueprint('turn_api', __name__)
 
-TURN_FILE = 'turn.json'
 ASSIGNED_FILE = 'assigned_ids.json'
-file_lock = threading.Lock()
 
 # -------------------------
-# JSONヘルパー
+# ターンの読み書き（GameState 経由）
 # -------------------------
-def load_json_file(filename):
-    with file_lock:
-        if os.path.exists(filename):
-            with open(filename) as f:
-                content = f.read().strip()
-                if not content:
-                    return {}
-                return json.loads(content)
-        return {}
-
-def save_json_file(filename, data):
-    with file_lock:
-        with open(filename, 'w') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        print(f"[ファイル書き込み] {filename} -> {data}")
-
 def load_current_turn():
-    data = load_json_file(TURN_FILE)
-    return data.get("current_turn")
+    return game_state.current_turn
 
 def save_current_turn(turn):
-    save_json_file(TURN_FILE, {"current_turn": turn})
+    game_state.update(current_turn=turn)
 
 # -------------------------
 # APIルート
@@ -41,9 +22,7 @@ def save_current_turn(turn):
 
 @turn_api.route('/turn', methods=['GET'])
 def get_turn():
-    turn = load_current_turn()
-    print(f"[API] 現在のターン取得 -> {turn}")
-    return jsonify({"current_turn": turn})
+    return conditional_json(lambda: {"current_turn": load_current_turn()}, "turn")
 
 @turn_api.route('/next_turn', methods=['POST'])
 def next_turn():
@@ -53,15 +32,8 @@ def next_turn():
     if not all_ids:
         return jsonify({"status": "error", "message": "割り当てIDがありません"}), 500
 
-    current = load_current_turn()
-    if current not in all_ids:
-        next_index = 0
-    else:
-        current_index = all_ids.index(current)
-        next_index = (current_index + 1) % len(all_ids)
-
-    next_id = all_ids[next_index]
-    save_current_turn(next_id)
+    # 読んでから進めるまでを GameState のロック内で行う
+    current, next_id = game_state.advance_turn(all_ids)
 
     print()
     print("=== [ターン進行] ===")